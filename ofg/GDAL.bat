@@ -1,11 +1,14 @@
 
 
 @echo off
-rem USAGE: GDAL.bat <file to process - no spaces in name> <zoom, format x-y> <needs translating>
+rem USAGE: GDAL.bat <file to process - no spaces in name> <zoom, format x-y> <needs translating> <jpeg quality> <product zip> <metadata file>
 
 set ARG1=%1
 set ARG2=%2
 set ARG3=%3
+set ARG4=%4
+set ARG5=%5
+set ARG6=%6
 
 rem set up environment for gdal
 set OSGEO4W_ROOT=Z:\Programs\OSGeo4W
@@ -19,17 +22,17 @@ if "%ARG3%"=="geonotranslate" GOTO GEONOTRANSLATE
 rem do processing
 
 gdal_translate -of vrt -expand rgba %ARG1% temp.vrt
-gdal2tiles -f jpeg -z %ARG2% -a 0 temp.vrt
+gdal2tiles -f jpeg -q %ARG4% -x ofm --tile-store zip --add-file %ARG6% -w none -z %ARG2% -a 0 temp.vrt %ARG5%
 GOTO END
 
 rem process non-georeferenced files
 :NOTRANSLATE
-gdal2tiles -p raster -f jpeg -z %ARG2% -a 0 %ARG1%
+gdal2tiles -p raster -f jpeg -q %ARG4% -x ofm --tile-store zip --add-file %ARG6% -w none -z %ARG2% -a 0 %ARG1% %ARG5%
 GOTO END
 
 rem process georeferenced tiffs that don't need the color space mumbo jumbo
 :GEONOTRANSLATE
-gdal2tiles -f jpeg -z %ARG2% -a 0 %ARG1%
+gdal2tiles -f jpeg -q %ARG4% -x ofm --tile-store zip --add-file %ARG6% -w none -z %ARG2% -a 0 %ARG1% %ARG5%
 GOTO END
 
 :END
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+#******************************************************************************
+#
+# Project:  OpenFlightGPS Companion Tools
+# Purpose:  Benchmark of the tile generation of gdal2tiles.py on synthetic charts
+#
+###############################################################################
+
+"""Benchmark of gdal2tiles.py on synthetic charts shaped like the FAA ones.
+
+The synthetic charts are RGB LZW GeoTIFFs in Lambert Conformal Conic, made once
+in the work directory and reused by the later runs:
+
+  - sectional: about 17k x 12k pixels of 42 m
+  - enroute:   about 12k x 9k pixels of 85 m
+
+Every case (chart x resampling x tile format) runs in a process of its own, so
+that the peak RSS is its own. The times of open_input, generate_base_tiles and
+generate_overview_tiles are measured, with the tiles/s, the bytes written and
+the peak RSS (not on Windows), and written as JSON. With --compare the results are
+checked against a stored baseline and the regressions beyond the threshold, and the
+cases failing now, are reported (exit status 1).
+
+Usage:
+  bench_gdal2tiles.py -o results.json
+  bench_gdal2tiles.py --chart sectional -r near -r antialias -f png --scale 0.25 -o new.json
+  bench_gdal2tiles.py --compare baseline.json new.json
+"""
+
+import sys
+import os
+import time
+import json
+import shutil
+import subprocess
+import tempfile
+from optparse import OptionParser
+
+# Peak RSS of the cases on Unix only, there is no resource module on Windows
+try:
+        import resource
+except ImportError:
+        resource = None
+
+# Synthetic charts: pixels, pixel size (m), standard parallels, origin
+charts = {
+        'sectional': dict(size=(17000, 12000), pixel=42.334, parallels=(33.0, 45.0), origin=(34.1666, -118.4666)),
+        'enroute': dict(size=(12000, 9000), pixel=84.667, parallels=(33.0, 45.0), origin=(38.0, -98.0)),
+}
+
+# Higher is better for these, lower for the others
+better_higher = ('tiles_per_second',)
+
+# =============================================================================
+
+def make_chart(name, path, scale):
+        """Write the synthetic chart: colour areas, a grid and fine line work in a white collar"""
+
+        from osgeo import gdal, osr
+
+        chart = charts[name]
+        xsize, ysize = int(chart['size'][0] * scale), int(chart['size'][1] * scale)
+        pixel = chart['pixel'] / scale
+
+        srs = osr.SpatialReference()
+        srs.SetLCC(chart['parallels'][0], chart['parallels'][1], chart['origin'][0], chart['origin'][1], 0, 0)
+        srs.SetWellKnownGeogCS('NAD83')
+
+        tempfilename = "%s.%d.tmp" % (path, os.getpid())
+        ds = gdal.GetDriverByName('GTiff').Create(tempfilename, xsize, ysize, 3, gdal.GDT_Byte,
+                                                  ['COMPRESS=LZW', 'TILED=NO', 'BIGTIFF=IF_SAFER'])
+        ds.SetProjection(srs.ExportToWkt())
+        ds.SetGeoTransform((-xsize / 2 * pixel, pixel, 0.0, ysize / 2 * pixel, 0.0, -pixel))
+
+        collar = xsize / 40
+        colors = ((246, 240, 222), (214, 232, 200), (190, 214, 236), (236, 222, 200))
+        for b in range(3):
+                # A handful of row patterns, shifted row by row
+                patterns = []
+                for p in range(16):
+                        row = []
+                        for x in range(0, xsize, 97):
+                                c = colors[(x / 1500 + p / 4) % len(colors)][b]
+                                if (x / 97 + p) % 11 == 0:
+                                        c = (60, 40, 140)[b]
+                                row.append(chr(c) * min(97, xsize - x))
+                        patterns.append("".join(row))
+                grid = chr((120, 60, 160)[b]) * xsize
+                white = chr(255) * xsize
+
+                band = ds.GetRasterBand(b+1)
+                chunk = 64
+                for y0 in range(0, ysize, chunk):
+                        rows = []
+                        for y in range(y0, min(ysize, y0 + chunk)):
+                                if y < collar or y >= ysize - collar:
+                                        rows.append(white)
+                                elif y % 500 < 3:
+                                        rows.append(grid)
+                                else:
+                                        shift = (y * 7) % xsize
+                                        row = patterns[y % 16]
+                                        row = row[shift:] + row[:shift]
+                                        rows.append(white[:collar] + row[collar:xsize-collar] + white[:collar])
+                        band.WriteRaster(0, y0, xsize, len(rows), "".join(rows))
+        ds = None
+        os.rename(tempfilename, path)
+
+# -------------------------------------------------------------------------
+
+def run_case(case, result_file):
+        """Run one case in this process and write its result into result_file"""
+
+        import gdal2tiles
+
+        # The output is a directory, or a file of the --tile-store given in the arguments
+        work_dir = tempfile.mkdtemp('-bench')
+        output = os.path.join(work_dir, 'tiles')
+        # The tiles and bytes are counted by the statistics of the tiler (the worker
+        # processes included), whatever the tile store and file names
+        arguments = ['-r', case['resampling'], '-w', 'none', '--stats', os.path.join(work_dir, 'stats.json')] + case['arguments']
+        if case['format'] != 'png':
+                arguments += ['--tile-format', case['format']]
+        arguments += [case['input'], output]
+
+        result = dict(case)
+        phases = {}
+        try:
+                tiler = gdal2tiles.GDAL2Tiles(arguments)
+                # No progress bars in the output of the benchmark
+                tiler.progressbar = lambda complete = 0.0: None
+
+                start = time.time()
+                tiler.open_input()
+                phases['open_input'] = time.time() - start
+
+                tiler.generate_metadata()
+
+                start = time.time()
+                tiler.generate_base_tiles()
+                phases['generate_base_tiles'] = time.time() - start
+
+                start = time.time()
+                tiler.generate_overview_tiles()
+                tiler.image_output.close()
+                tiler.store.close()
+                phases['generate_overview_tiles'] = time.time() - start
+        except SystemExit:
+                result['error'] = "gdal2tiles failed"
+        else:
+                tiles = gdal2tiles.STATS.calls('encode') + gdal2tiles.STATS.calls('link')
+                size = gdal2tiles.STATS.as_dict()['phases'].get('encode', {}).get('bytes', 0)
+                tile_time = phases['generate_base_tiles'] + phases['generate_overview_tiles']
+                result.update(phases=phases, tiles=tiles, bytes=size,
+                              tiles_per_second=tiles / tile_time if tile_time else 0.0)
+
+        # ru_maxrss in kilobytes (Linux), the worker processes of --processes included
+        if resource is not None:
+                result['peak_rss_kb'] = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        shutil.rmtree(work_dir, True)
+
+        f = open(result_file, 'w')
+        json.dump(result, f)
+        f.close()
+
+# -------------------------------------------------------------------------
+
+def case_key(result):
+        return (result['chart'], result['resampling'], result['format'])
+
+def compare(baseline, results, threshold):
+        """Print the comparison of the results with the baseline, return the number of regressions.
+        A case failing now but not in the baseline is a regression too."""
+
+        base = dict((case_key(r), r) for r in baseline['results'])
+        regressions = 0
+        for r in results['results']:
+                b = base.get(case_key(r))
+                if b is None or 'error' in b:
+                        continue
+                if 'error' in r:
+                        print "%-10s %-12s %-7s %s  REGRESSION" % (r['chart'], r['resampling'], r['format'], r['error'])
+                        regressions += 1
+                        continue
+                metrics = [('tiles_per_second', b['tiles_per_second'], r['tiles_per_second'])]
+                if 'peak_rss_kb' in b and 'peak_rss_kb' in r:
+                        metrics.append(('peak_rss_kb', b['peak_rss_kb'], r['peak_rss_kb']))
+                metrics += [(phase, b['phases'][phase], r['phases'][phase]) for phase in sorted(r['phases'])
+                            if phase in b['phases']]
+                for metric, old, new in metrics:
+                        if not old:
+                                continue
+                        change = (new - old) / float(old)
+                        if metric in better_higher:
+                                change = -change
+                        flag = ""
+                        if change > threshold:
+                                flag = "  REGRESSION"
+                                regressions += 1
+                        print "%-10s %-12s %-7s %-24s %12.2f -> %12.2f %+7.1f%%%s" % (
+                                r['chart'], r['resampling'], r['format'], metric, old, new, 100 * change, flag)
+        return regressions
+
+# -------------------------------------------------------------------------
+
+def main():
+        import gdal2tiles
+
+        p = OptionParser("%prog [options] [-o results.json] | --compare baseline.json results.json")
+        p.add_option('--chart', dest='charts', action='append', type='choice', choices=sorted(charts),
+                     help="Synthetic chart (%s) - default all" % ",".join(sorted(charts)))
+        p.add_option('-r', '--resampling', dest='resampling', action='append', type='choice', choices=gdal2tiles.resampling_list,
+                     help="Resampling method (%s) - default all" % ",".join(gdal2tiles.resampling_list))
+        p.add_option('-f', '--format', dest='formats', action='append', type='choice', choices=gdal2tiles.tile_formats_list,
+                     help="Tile format (%s) - default all" % ",".join(gdal2tiles.tile_formats_list))
+        p.add_option('--scale', dest='scale', type='float',
+                     help="Scale of the synthetic charts, smaller for quick runs - default 1.0")
+        p.add_option('--args', dest='arguments',
+                     help="More gdal2tiles arguments for all the cases, e.g. \"-z 6-10 --processes 4\"")
+        p.add_option('--work-dir', dest='work_dir',
+                     help="Directory of the synthetic charts - default bench-charts")
+        p.add_option('-o', '--output', dest='output',
+                     help="JSON file of the results - default printed")
+        p.add_option('--compare', dest='compare', metavar='BASELINE',
+                     help="Compare the results (JSON file given, or of this run) with the BASELINE")
+        p.add_option('--threshold', dest='threshold', type='float',
+                     help="Relative change flagged as a regression - default 0.10")
+        p.add_option('--case', dest='case', help="(internal) Run the case given as JSON")
+        p.set_defaults(charts=None, resampling=None, formats=None, scale=1.0, arguments='',
+                       work_dir='bench-charts', output=None, compare=None, threshold=0.10, case=None)
+        options, args = p.parse_args()
+
+        if options.case:
+                run_case(json.loads(options.case), args[0])
+                return 0
+
+        if options.compare and args:
+                results = json.load(open(args[0]))
+                return compare(json.load(open(options.compare)), results, options.threshold) and 1 or 0
+
+        if not os.path.isdir(options.work_dir):
+                os.makedirs(options.work_dir)
+
+        results = dict(created=time.strftime("%Y-%m-%dT%H:%M:%S"), scale=options.scale,
+                       arguments=options.arguments, results=[])
+        for chart in options.charts or sorted(charts):
+                path = os.path.join(options.work_dir, "%s-%g.tif" % (chart, options.scale))
+                if not os.path.exists(path):
+                        print "Making the synthetic %s chart %s" % (chart, path)
+                        make_chart(chart, path, options.scale)
+
+                for resampling in options.resampling or gdal2tiles.resampling_list:
+                        for tile_format in options.formats or gdal2tiles.tile_formats_list:
+                                case = dict(chart=chart, input=path, resampling=resampling, format=tile_format,
+                                            arguments=options.arguments.split())
+                                fd, result_file = tempfile.mkstemp('-bench.json')
+                                os.close(fd)
+                                subprocess.call([sys.executable, os.path.abspath(__file__), '--case', json.dumps(case), result_file],
+                                                stdout=open(os.devnull, 'w'))
+                                try:
+                                        result = json.load(open(result_file))
+                                except ValueError:
+                                        result = dict(case, error="the benchmark process failed")
+                                os.unlink(result_file)
+                                del result['input']
+                                results['results'].append(result)
+
+                                if 'error' in result:
+                                        print "%-10s %-12s %-7s %s" % (chart, resampling, tile_format, result['error'])
+                                else:
+                                        print "%-10s %-12s %-7s %8d tiles %10.1f tiles/s %12d bytes %8s kB RSS" % (
+                                                chart, resampling, tile_format, result['tiles'],
+                                                result['tiles_per_second'], result['bytes'], result.get('peak_rss_kb', '-'))
+
+        if options.output:
+                f = open(options.output, 'w')
+                json.dump(results, f, indent=1, sort_keys=True)
+                f.close()
+        else:
+                print json.dumps(results, indent=1, sort_keys=True)
+
+        if options.compare:
+                return compare(json.load(open(options.compare)), results, options.threshold) and 1 or 0
+        return 0
+
+# =============================================================================
+
+if __name__ == '__main__':
+        sys.exit(main())
@@ -43,25 +43,50 @@
 
 from osgeo import gdal
 from osgeo import osr
+from osgeo import ogr
 
 import sys
 import os
+import shutil
 import math
+import time
+import hashlib
+import array
+import zipfile
+import sqlite3
+import threading
+import Queue
+import shlex
+import cPickle
+import tempfile
+import json
+from collections import OrderedDict
 
 try:
         from PIL import Image
-        import numpy
-        import osgeo.gdal_array as gdalarray
 except:
         # 'antialias' resampling is not available
         pass
 
+try:
+        import numpy
+except:
+        # 'box' resampling is not available
+        pass
+
 __version__ = "$Id: gdal2tiles.py 15748 2008-11-17 16:30:54Z klokan $"
 
-resampling_list = ('average','near','bilinear','cubic','cubicspline','lanczos','antialias')
+resampling_list = ('average','near','bilinear','cubic','cubicspline','lanczos','antialias','box')
 tile_formats_list = ('png', 'jpeg', 'hybrid')
 profile_list = ('mercator','geodetic','raster','gearth') #,'zoomify')
 webviewer_list = ('all','google','openlayers','none')
+tile_store_list = ('files', 'zip', 'mbtiles')
+
+# Number of tiles handed to a worker process at once by --processes
+TILE_BATCH_SIZE = 16
+
+# Seconds between the throughput lines of --stats
+STATS_INTERVAL = 60
 
 format_extension = {
         "PNG" : "png",
@@ -427,18 +452,176 @@ class GDAL2Tiles(object):
         def process(self):
                 """The main processing function, runs all the main steps of processing"""
                 
+                if self.options.batch:
+                        self.process_batch()
+                        return
+
+                self.start_time = time.time()
+                STATS.clear()
+
                 # Opening and preprocessing of the input file
                 self.open_input()
+                self.stages['open_input'] = time.time() - self.start_time
 
                 # Generation of main metadata files and HTML viewers
                 self.generate_metadata()
+
+                if self.options.record_empty:
+                        self.write_empty_tiles()
+
+                try:
+                        if self.options.depth_first:
+                                # Generation of all the tiles in one pass, every parent right after its children
+                                t = time.time()
+                                self.generate_tiles_depth_first()
+                                self.stages['depth_first_tiles'] = time.time() - t
+                        else:
+                                # Generation of the lowest tiles
+                                t = time.time()
+                                self.generate_base_tiles()
+                                self.stages['base_tiles'] = time.time() - t
+
+                                # Generation of the overview tiles (higher in the pyramid)
+                                t = time.time()
+                                self.generate_overview_tiles()
+                                self.stages['overview_tiles'] = time.time() - t
+                except SystemExit:
+                        # Stopped by an error: the tiles written so far are kept in a closed store
+                        # (the ZIP archive finalised, the journal kept for --resume)
+                        try:
+                                self.image_output.close()
+                        except ImageOutputException:
+                                pass
+                        self.store.close(False)
+                        self.close_input()
+                        raise
+
+                t = time.time()
+                try:
+                        self.image_output.close()
+                except ImageOutputException, e:
+                        self.error(e.message)
+                self.store.close()
+                if self.previous_store:
+                        self.previous_store.close()
+                self.close_input()
+                self.stages['close'] = time.time() - t
+
+                if self.options.stats:
+                        self.stats = self.collect_stats()
+                        # The statistics of the charts of a --batch are written together
+                        if not self.in_batch:
+                                self.write_stats(self.stats)
+
+        # -------------------------------------------------------------------------
+        def collect_stats(self):
+                """Return the statistics of the run, for the --stats file"""
+
+                stats = STATS.as_dict()
+                stats.update(input=self.inputs, output=self.output, seconds=time.time() - self.start_time,
+                             tiles=STATS.calls('encode') + STATS.calls('link'),
+                             stages=dict(self.stages))
+                return stats
+
+        # -------------------------------------------------------------------------
+        def write_stats(self, stats):
+                """Write the statistics into the --stats file as JSON"""
+
+                f = open(self.options.stats, 'w')
+                json.dump(stats, f, indent=1, sort_keys=True)
+                f.close()
                 
-                # Generation of the lowest tiles
-                self.generate_base_tiles()
-                
-                # Generation of the overview tiles (higher in the pyramid)
-                self.generate_overview_tiles()
-                
+        # -------------------------------------------------------------------------
+        def read_batch(self, arguments):
+                """Return the arguments of every chart of the --batch file: one chart per line,
+                with the gdal2tiles options and arguments of the chart. The options given
+                on the command line besides --batch apply to all of them, unless overridden."""
+
+                common = []
+                skip = False
+                for arg in arguments:
+                        if skip:
+                                skip = False
+                        elif arg == '--batch':
+                                skip = True
+                        elif not arg.startswith('--batch='):
+                                common.append(arg)
+
+                try:
+                        f = open(self.options.batch)
+                except IOError, e:
+                        self.error("It is not possible to read the batch file '%s': %s" % (self.options.batch, e.strerror))
+                batch = []
+                for line in f:
+                        # Not in POSIX mode, the backslashes of the Windows paths are no escapes
+                        args = [strip_quotes(arg) for arg in shlex.split(line, comments=True, posix=False)]
+                        if args:
+                                batch.append(common + args)
+                f.close()
+
+                if not batch:
+                        self.error("The batch file '%s' lists no input file." % self.options.batch)
+                return batch
+
+        # -------------------------------------------------------------------------
+        def process_batch(self):
+                """Processing of all the charts of the --batch file in this one process. With
+                at least as many charts as worker processes every worker takes whole charts,
+                otherwise the charts are processed one after another on one pool of workers
+                shared by all of them. The --stats file gets the statistics of every chart."""
+
+                import multiprocessing
+
+                processes = self.options.processes
+                chart_parallel = processes > 1 and len(self.batch_arguments) >= processes
+
+                # Set up all the charts first, a bad line stops the batch before any work. The
+                # charts processed by the workers one each are checked as they are run there.
+                if chart_parallel:
+                        charts = []
+                        for arguments in self.batch_arguments:
+                                arguments = arguments + ['--processes', '1']
+                                # The charts processed side by side share the CPUs already
+                                if not [arg for arg in arguments if arg.startswith('--warp-threads')]:
+                                        arguments += ['--warp-threads', '1']
+                                charts.append(GDAL2Tiles(arguments))
+                else:
+                        charts = [GDAL2Tiles(arguments) for arguments in self.batch_arguments]
+
+                chart_stats = []
+                if chart_parallel:
+                        pool = multiprocessing.Pool(processes)
+                        done = 0
+                        try:
+                                for output, stats in pool.imap_unordered(chart_worker, [chart.arguments for chart in charts], 1):
+                                        done += 1
+                                        chart_stats.append(stats)
+                                        print "Finished %s (%d/%d)" % (output, done, len(charts))
+                        except ImageOutputException, e:
+                                pool.terminate()
+                                self.error(e.message)
+                        pool.close()
+                        pool.join()
+                else:
+                        if processes > 1:
+                                self.pool = multiprocessing.Pool(processes)
+                        while charts:
+                                # A finished chart is let go with its datasets, caches and store
+                                chart = charts.pop(0)
+                                print "Processing %s:" % chart.input
+                                chart.pool = self.pool
+                                chart.in_batch = True
+                                chart.process()
+                                chart_stats.append(chart.stats)
+                                chart = None
+                        if self.pool:
+                                self.pool.close()
+                                self.pool.join()
+
+                if self.options.stats:
+                        self.write_stats({'charts': chart_stats, 'seconds': time.time() - self.start_time,
+                                          'tiles': sum(stats['tiles'] for stats in chart_stats)})
+
         # -------------------------------------------------------------------------
         def error(self, msg, details = "" ):
                 """Print an error message and stop the processing"""
@@ -453,6 +636,41 @@ class GDAL2Tiles(object):
                 """Print progressbar for float value 0..1"""
                 
                 gdal.TermProgress_nocb(complete)
+                if STATS.enabled:
+                        self.report_throughput(complete)
+
+        # -------------------------------------------------------------------------
+        def report_progress(self, complete):
+                """Progress of the tile loops: the progressbar, with --verbose (which prints
+                every tile instead) the throughput lines of --stats only"""
+
+                if not self.options.verbose:
+                        self.progressbar(complete)
+                elif STATS.enabled:
+                        self.report_throughput(complete)
+
+        # -------------------------------------------------------------------------
+        def report_throughput(self, complete):
+                """Print the tiles written, the throughput and the ETA of the current phase
+                every STATS_INTERVAL seconds, for the long runs with --stats"""
+
+                now = time.time()
+                if self.progress is None or complete < self.progress[2]:
+                        # A new phase
+                        self.progress = (now, now, complete)
+                        return
+                start, reported, last = self.progress
+                if now - reported < STATS_INTERVAL:
+                        self.progress = (start, reported, complete)
+                        return
+                self.progress = (start, now, complete)
+
+                tiles = STATS.calls('encode') + STATS.calls('link')
+                eta = 0
+                if complete:
+                        eta = int((now - start) * (1 - complete) / complete)
+                print >> sys.stderr, "%d tiles written, %.1f tiles/s, %d%% of the phase done, ETA %d:%02d:%02d" % (
+                        tiles, tiles / (now - self.start_time), 100 * complete, eta / 3600, eta / 60 % 60, eta % 60)
 
         # -------------------------------------------------------------------------
         def stop(self):
@@ -467,6 +685,31 @@ class GDAL2Tiles(object):
                 self.input = None
                 self.output = None
 
+                # Kept for the worker processes, which set up their own copy of the input
+                self.arguments = arguments
+                # Set in the worker processes, these must not start the output from scratch
+                self.is_worker = False
+                # Set for the charts of a --batch, these leave the --stats file to the batch
+                self.in_batch = False
+                self.stats = None
+                # Warped intermediate of --warp-cache, passed on to the worker processes
+                self.warp_cache_file = None
+                # Reader composing the inputs of --mosaic, None for a single input
+                self.mosaic = None
+                # Warped VRTs of the input in /vsimem/, removed with the input
+                self.vsimem_files = []
+                self.image_output = None
+                # Tiles changed since the --previous edition by zoom level, None renders all
+                self.dirty_tiles = None
+                self.coverage = None
+                # Wall clock times of the main steps and the progress of the phase, for --stats
+                self.start_time = time.time()
+                self.stages = OrderedDict()
+                self.progress = None
+                self.previous_store = None
+                # Pool of worker processes shared by the charts of a --batch, else one per phase
+                self.pool = None
+
                 # Tile format
                 self.tilesize = 512
 
@@ -489,6 +732,15 @@ class GDAL2Tiles(object):
                 
                 self.optparse_init()
                 self.options, self.args = self.parser.parse_args(args=arguments)
+
+                if self.options.stats:
+                        STATS.enabled = True
+
+                if self.options.batch:
+                        # Every chart of the batch is set up by its own GDAL2Tiles in process_batch()
+                        self.batch_arguments = self.read_batch(arguments)
+                        return
+
                 if not self.args:
                         self.error("No input file specified")
 
@@ -509,14 +761,16 @@ class GDAL2Tiles(object):
                         self.output = self.args[-1]
                         self.args = self.args[:-1]
 
-                # More files on the input not directly supported yet
+                # More files on the input are supported as a --mosaic only
                 
-                if (len(self.args) > 1):
-                        self.error("Processing of several input files is not supported.",
-                        """Please first use a tool like gdal_vrtmerge.py or gdal_merge.py on the files:
-gdal_vrtmerge.py -o merged.vrt %s""" % " ".join(self.args))
-                        # TODO: Call functions from gdal_vrtmerge.py directly
+                if (len(self.args) > 1) and not self.options.mosaic:
+                        self.error("Processing of several input files is supported with --mosaic only.",
+                        """Either tile them as one mosaic by:
+gdal2tiles --mosaic %s output
+or first use a tool like gdal_vrtmerge.py or gdal_merge.py on the files:
+gdal_vrtmerge.py -o merged.vrt %s""" % (" ".join(self.args), " ".join(self.args)))
                         
+                self.inputs = self.args
                 self.input = self.args[0]
                 
                 # Default values for not given options
@@ -524,15 +778,71 @@ gdal_vrtmerge.py -o merged.vrt %s""" % " ".join(self.args))
                 if not self.output:
                         # Directory with input filename without extension in actual directory
                         self.output = os.path.splitext(os.path.basename( self.input ))[0]
+
+                if self.options.tile_store in ('zip', 'mbtiles') and not self.output.lower().endswith('.' + self.options.tile_store):
+                        self.output += '.' + self.options.tile_store
                                 
                 if not self.options.title:
-                        self.options.title = os.path.basename( self.input )
+                        if self.options.mosaic:
+                                self.options.title = os.path.basename( self.output )
+                        else:
+                                self.options.title = os.path.basename( self.input )
 
                 if self.options.url and not self.options.url.endswith('/'):
                         self.options.url += '/'
                 if self.options.url:
                         self.options.url += os.path.basename( self.output ) + '/'
 
+                if self.options.processes < 1:
+                        self.error("The number of processes must be at least 1.")
+
+                # The worker processes share the CPUs already
+                if self.options.warp_threads is None:
+                        if self.options.processes > 1:
+                                self.options.warp_threads = '1'
+                        else:
+                                self.options.warp_threads = 'ALL_CPUS'
+
+                # Metatile of N x N tiles, N = 2**metatile_shift
+                self.metatile_shift = 0
+                while (1 << self.metatile_shift) < self.options.metatile:
+                        self.metatile_shift += 1
+                if (1 << self.metatile_shift) != self.options.metatile:
+                        self.error("The metatile size must be a power of 2.")
+
+                if self.options.mosaic and self.options.profile not in ('mercator', 'geodetic', 'gearth'):
+                        self.error("The --mosaic option is supported for the 'mercator', 'geodetic' and 'gearth' profiles only.")
+
+                if self.options.cutline and self.options.profile not in ('mercator', 'geodetic', 'gearth'):
+                        self.error("The --cutline option is supported for the 'mercator', 'geodetic' and 'gearth' profiles only.")
+
+                if self.options.cutline and len(self.options.cutline) not in (1, len(self.inputs)):
+                        self.error("Give one --cutline for all the inputs, or one for every input of the --mosaic.")
+
+                if self.options.mosaic and self.options.previous:
+                        self.error("The --previous option is not supported with --mosaic.")
+
+                if bool(self.options.previous) != bool(self.options.previous_output):
+                        self.error("The --previous and --previous-output options go together.")
+
+                if self.options.previous and self.options.profile not in ('mercator', 'geodetic'):
+                        self.error("The --previous option is supported for the 'mercator' and 'geodetic' profiles only.")
+
+                if self.options.previous_output and not os.path.exists(self.options.previous_output):
+                        self.error("The previous output '%s' does not exist." % self.options.previous_output)
+
+                if self.options.previous_output and os.path.abspath(self.options.previous_output) == os.path.abspath(self.output):
+                        self.error("The previous output can't be overwritten by the new one, use another output.")
+
+                if self.options.write_threads < 0:
+                        self.error("The number of write threads can't be negative.")
+
+                if self.options.processes > 1 and self.options.tile_store == 'zip':
+                        self.error("The 'zip' tile store can be written by one process only, use --processes 1.")
+
+                if self.options.tile_store == 'mbtiles' and self.options.tile_format == 'hybrid':
+                        self.error("The 'mbtiles' tile store holds tiles of one image format only, 'hybrid' is not supported.")
+
                 # Supported options
                 
                 if self.options.resampling == 'average':
@@ -543,11 +853,18 @@ gdal_vrtmerge.py -o merged.vrt %s""" % " ".join(self.args))
                                 self.error("'average' resampling algorithm is not available.", "Please use -r 'near' argument or upgrade to newer version of GDAL.")
                 
                 elif self.options.resampling == 'antialias':
+                        try:
+                                if Image:
+                                        pass
+                        except:
+                                self.error("'antialias' resampling algorithm is not available.", "Install PIL (Python Imaging Library).")
+                
+                elif self.options.resampling == 'box':
                         try:
                                 if numpy:
                                         pass
                         except:
-                                self.error("'antialias' resampling algorithm is not available.", "Install PIL (Python Imaging Library) and numpy.")
+                                self.error("'box' resampling algorithm is not available.", "Install numpy or use -r 'average'.")
                 
                 elif self.options.resampling == 'near':
                         self.querysize = self.tilesize
@@ -564,6 +881,12 @@ gdal_vrtmerge.py -o merged.vrt %s""" % " ".join(self.args))
 
 				self.options.webviewer = 'none'
 
+                if self.options.tile_ext and self.options.tile_format == 'hybrid':
+                        self.error("The tile extension can't be changed for 'hybrid' tiles, these use both 'png' and 'jpg'.")
+
+                if self.options.jpeg_quality is not None and not 1 <= self.options.jpeg_quality <= 100:
+                        self.error("The JPEG quality must be between 1 and 100.")
+
                 # User specified zoom levels
                 self.tminz = None
                 self.tmaxz = None
@@ -583,7 +906,7 @@ gdal_vrtmerge.py -o merged.vrt %s""" % " ".join(self.args))
 
                 if self.options.verbose:
                         print "Options:", self.options
-                        print "Input:", self.input
+                        print "Input:", " ".join(self.inputs)
                         print "Output:", self.output
                         print "Cache: %s MB" % (gdal.GetCacheMax() / 1024 / 1024)
                         print
@@ -601,6 +924,16 @@ gdal_vrtmerge.py -o merged.vrt %s""" % " ".join(self.args))
                                                 help="Resampling method (%s) - default 'average'" % ",".join(resampling_list))
                 p.add_option("-f", "--tile-format", dest="tile_format", type='choice', choices=tile_formats_list,
                                                 help="Image format of generated tiles (%s) - default 'png'" % ",".join(tile_formats_list))
+                p.add_option('-q', '--jpeg-quality', dest="jpeg_quality", type='int', metavar="QUALITY",
+                                                help="Quality of the JPEG tiles (1-100) - default 75")
+                p.add_option('-x', '--tile-ext', dest="tile_ext", metavar="EXT",
+                                                help="File extension of the tiles instead of 'png'/'jpg' (not for 'hybrid')")
+                p.add_option('--co', dest="creation_options", action="append", metavar="NAME=VALUE",
+                                                help="Creation option passed to the tile image driver, may be repeated")
+                p.add_option('--tile-store', dest="tile_store", type='choice', choices=tile_store_list,
+                                                help="Where the tiles are written (%s) - default 'files' in the output directory, 'zip' streams them into the output .zip, 'mbtiles' into the output .mbtiles SQLite file" % ",".join(tile_store_list))
+                p.add_option('--add-file', dest="add_files", action="append", metavar="FILE[=NAME]",
+                                                help="File stored along with the tiles and metadata (optionally under another name), may be repeated")
                 p.add_option('-s', '--s_srs', dest="s_srs", metavar="SRS",
                                                   help="The spatial reference system used for the source input data")
                 p.add_option('-z', '--zoom', dest="zoom",
@@ -609,6 +942,40 @@ gdal_vrtmerge.py -o merged.vrt %s""" % " ".join(self.args))
                                                   help="Resume mode. Generate only missing files.")
                 p.add_option('-a', '--srcnodata', dest="srcnodata", metavar="NODATA",
                                                   help="NODATA transparency value to assign to the input data")
+                p.add_option('--batch', dest="batch", metavar="FILE",
+                                                  help="Process all the charts listed in FILE in this one process, one chart per line given by its gdal2tiles options and arguments")
+                p.add_option('-P', '--processes', dest="processes", type='int',
+                                                  help="Number of worker processes rendering the tiles in parallel - default 1")
+                p.add_option('--split-zoom', dest="split_zoom", type='int', metavar="ZOOM",
+                                                  help="Zoom level at which the overview pyramid is split between the worker processes - default chosen by the number of processes")
+                p.add_option('--depth-first', dest="depth_first", action="store_true",
+                                                  help="Generate the base and overview tiles in one depth-first pass, every parent right after its four children")
+                p.add_option('--warp-threads', dest="warp_threads", metavar="N",
+                                                  help="Threads warping the input into the tile projection, a number or ALL_CPUS - default ALL_CPUS, 1 with --processes")
+                p.add_option('--warp-memory', dest="warp_memory", type='int', metavar="MB",
+                                                  help="Memory of the warper working buffers - default 64 MB")
+                p.add_option('--warp-error-threshold', dest="warp_error_threshold", type='float', metavar="PIXELS",
+                                                  help="Error threshold of the approximate warp transformer, 0 for the exact one - default 0.125")
+                p.add_option('--warp-cache', dest="warp_cache", metavar="DIR",
+                                                  help="Warp the input once into a GeoTIFF aligned to the base tiles, kept in DIR and reused by the later runs on the same input and settings ('mercator' and 'geodetic' profiles)")
+                p.add_option('--mosaic', dest="mosaic", action="store_true",
+                                                  help="Tile all the input files as one seamless mosaic, the first input on top where they overlap")
+                p.add_option('--cutline', dest="cutline", action="append", metavar="SOURCE",
+                                                  help="OGR datasource with the polygon of the map body, the legends, insets and collar outside it are masked out and their tiles are not generated (one for all the inputs, or one per input of a --mosaic)")
+                p.add_option('--record-empty', dest="record_empty", action="store_true",
+                                                  help="List the empty tiles, those not generated for having no valid pixel of the input, in 'empty.txt' of the output")
+                p.add_option('--stats', dest="stats", metavar="FILE",
+                                                  help="Write the time, calls and bytes of the phases of the tile generation and the tile sizes by zoom level into FILE as JSON (of every chart with --batch), print the throughput every minute")
+                p.add_option('--previous', dest="previous", metavar="RASTER",
+                                                  help="Previous edition of the input raster, only the tiles covering the pixels changed since are generated (with --previous-output)")
+                p.add_option('--previous-output', dest="previous_output", metavar="PATH",
+                                                  help="Output of the previous edition (same --tile-store), the unchanged tiles are copied or linked from it")
+                p.add_option('--metatile', dest="metatile", type='int', metavar="N",
+                                                  help="Read and resample the base tiles in blocks of NxN tiles at once, N a power of 2 - default 1 (every tile alone), 'mercator' and 'geodetic' profiles only")
+                p.add_option('--write-threads', dest="write_threads", type='int', metavar="N",
+                                                  help="Threads encoding and writing the tiles while the next ones are read and resampled - default 0 (no threads)")
+                p.add_option('--tile-cache', dest="tile_cache", type='int', metavar="MB",
+                                                  help="Memory for the decoded tiles kept to build the overview tiles without reading them back from disk - default 128 MB, 0 disables")
                 p.add_option("-v", "--verbose",
                                                   action="store_true", dest="verbose",
                                                   help="Print status messages to stdout")
@@ -646,7 +1013,10 @@ gdal_vrtmerge.py -o merged.vrt %s""" % " ".join(self.args))
                 # p.add_option_group(g)
 
                 p.set_defaults(verbose=False, profile="mercator", kml=False, url='',
-                copyright='', resampling='average', resume=False,
+                copyright='', resampling='average', resume=False, processes=1, split_zoom=None, tile_cache=128, depth_first=False, metatile=1,
+                warp_threads=None, warp_memory=64, warp_error_threshold=0.125, warp_cache=None,
+                previous=None, previous_output=None, write_threads=0, batch=None, mosaic=False, cutline=None, record_empty=False, stats=None,
+                jpeg_quality=None, tile_ext=None, creation_options=None, tile_store='files', add_files=None,
                 googlekey='INSERT_YOUR_KEY_HERE', yahookey='INSERT_YOUR_YAHOO_APP_ID_HERE')
 
                 self.parser = p
@@ -662,8 +1032,13 @@ gdal_vrtmerge.py -o merged.vrt %s""" % " ".join(self.args))
                 gdal.AllRegister()
 
                 # Open the input file
-                if self.input:
+                if len(self.inputs) > 1:
+                        self.in_ds = self.open_mosaic()
+                        self.input_files = self.mosaic_files
+                elif self.input:
                         self.in_ds = gdal.Open(self.input, gdal.GA_ReadOnly)
+                        if self.in_ds:
+                                self.input_files = self.in_ds.GetFileList() or [self.input]
                 else:
                         raise Exception("No input file was specified")
 
@@ -687,8 +1062,8 @@ then run:
 gdal2tiles temp.vrt""" % self.input )
 
                 # Get NODATA value
-                # User supplied values overwrite everything else.
-                if self.options.srcnodata:
+                # User supplied values overwrite everything else, those of a mosaic are in its alpha band.
+                if self.options.srcnodata and len(self.inputs) == 1:
                         nds = map( float, self.options.srcnodata.split(','))
                         if len(nds) < self.in_ds.RasterCount:
                                 self.in_nodata = (nds * self.in_ds.RasterCount)[:self.in_ds.RasterCount]
@@ -723,7 +1098,7 @@ gdal2tiles temp.vrt""" % self.input )
 
                 self.in_srs = None
                 
-                if self.options.s_srs:
+                if self.options.s_srs and len(self.inputs) == 1:
                         self.in_srs = osr.SpatialReference()
                         self.in_srs.SetFromUserInput(self.options.s_srs)
                         self.in_srs_wkt = self.in_srs.ExportToWkt()
@@ -760,21 +1135,29 @@ gdal2tiles temp.vrt""" % self.input )
                                 
                         if self.in_srs:
                                 
-                                if (self.in_srs.ExportToProj4() != self.out_srs.ExportToProj4()) or (self.in_ds.GetGCPCount() != 0):
+                                # The cutline is applied by the warp, of the single input (those of a mosaic are warped already)
+                                if ((self.in_srs.ExportToProj4() != self.out_srs.ExportToProj4()) or (self.in_ds.GetGCPCount() != 0)
+                                    or (self.options.cutline and len(self.inputs) == 1)):
                                         
                                         # Generation of VRT dataset in tile projection, default 'nearest neighbour' warping
-                                        self.out_ds = gdal.AutoCreateWarpedVRT( self.in_ds, self.in_srs_wkt, self.out_srs.ExportToWkt() )
+                                        legacy_warp = not hasattr(gdal, 'Warp')
+                                        if legacy_warp and self.options.cutline:
+                                                self.error("The --cutline option needs GDAL with gdal.Warp (GDAL 2.1 or newer).")
+                                        if legacy_warp:
+                                                self.out_ds = gdal.AutoCreateWarpedVRT( self.in_ds, self.in_srs_wkt, self.out_srs.ExportToWkt() )
+                                        else:
+                                                self.out_ds = self.warp_input()
                                         
                                         # TODO: HIGH PRIORITY: Correction of AutoCreateWarpedVRT according the max zoomlevel for correct direct warping!!!
                                         
                                         if self.options.verbose:
-                                                print "Warping of the raster by AutoCreateWarpedVRT (result saved into 'tiles.vrt')"
+                                                print "Warping of the raster by %s (result saved into 'tiles.vrt')" % (legacy_warp and "AutoCreateWarpedVRT" or "gdal.Warp")
                                                 self.out_ds.GetDriver().CreateCopy("tiles.vrt", self.out_ds)
                                                 
                                         # Note: self.in_srs and self.in_srs_wkt contain still the non-warped reference system!!!
 
                                         # Correction of AutoCreateWarpedVRT for NODATA values
-                                        if self.in_nodata != []:
+                                        if legacy_warp and self.in_nodata != []:
                                                 import tempfile
                                                 tempfilename = tempfile.mktemp('-gdal2tiles.vrt')
                                                 self.out_ds.GetDriver().CreateCopy(tempfilename, self.out_ds)
@@ -810,7 +1193,7 @@ gdal2tiles temp.vrt""" % self.input )
                                         # -----------------------------------
                                         # Correction of AutoCreateWarpedVRT for Mono (1 band) and RGB (3 bands) files without NODATA:
                                         # equivalent of gdalwarp -dstalpha
-                                        if self.in_nodata == [] and self.out_ds.RasterCount in [1,3]:
+                                        if legacy_warp and self.in_nodata == [] and self.out_ds.RasterCount in [1,3]:
                                                 import tempfile
                                                 tempfilename = tempfile.mktemp('-gdal2tiles.vrt')
                                                 self.out_ds.GetDriver().CreateCopy(tempfilename, self.out_ds)
@@ -861,10 +1244,6 @@ gdal2tiles temp.vrt""" % self.input )
                         if self.options.verbose:
                                 print "KML autotest OK!"
 
-                # Instantiate image output.
-                self.image_output = ImageOutput(self.options.tile_format, self.out_ds, self.tilesize,
-                                                                                self.options.resampling, self.in_nodata, self.output)
-
                 # Read the georeference 
 
                 self.out_gt = self.out_ds.GetGeoTransform()
@@ -995,12 +1374,513 @@ gdal2tiles temp.vrt""" % self.input )
 
                         self.tileswne = lambda x, y, z: (0,0,0,0)
 
+                # Only the tiles meeting the map body are generated
+                self.cutline_geom = None
+                if self.options.cutline and self.options.profile in ('mercator', 'geodetic'):
+                        self.cutline_geom = self.open_cutline()
+
+                # Tiles with valid pixels of the input, found once in the main process
+                if self.options.profile in ('mercator', 'geodetic') and not self.is_worker:
+                        self.coverage = self.find_coverage()
+
+                # Base tiles read from the cached warped intermediate, aligned to them
+                if self.options.warp_cache and self.options.profile in ('mercator', 'geodetic'):
+                        self.out_ds = self.open_warp_cache()
+                        self.out_gt = self.out_ds.GetGeoTransform()
+                        self.querysize = self.tilesize
+                        # The inputs of a mosaic are composed in the cache already
+                        self.mosaic = None
+
+                # Tiles changed since the previous edition, found once in the main process
+                if self.options.previous:
+                        if not self.is_worker:
+                                self.dirty_tiles = self.find_dirty_tiles()
+                        self.previous_store = TileStore(self.options.tile_store, self.options.previous_output, False,
+                                                        TileIndex(self.tminmax, range(self.tminz, self.tmaxz+1)), True)
+
+                # Instantiate tile store and image output.
+                try:
+                        self.store = TileStore(self.options.tile_store, self.output,
+                                               not self.options.resume and not self.is_worker,
+                                               TileIndex(self.tminmax, range(self.tminz, self.tmaxz+1)))
+                except zipfile.BadZipfile:
+                        # An interrupted run leaves the archive without its central directory
+                        self.error("The ZIP archive '%s' is incomplete or damaged, it can't be resumed." % self.output,
+                                   "Run again without --resume to write it anew.")
+
+                tile_cache_size = self.options.tile_cache * 1024 * 1024
+                if self.options.depth_first:
+                        # Room for the four children pending on every level, so that they never
+                        # have to be read back from disk
+                        tile_cache_size = max(tile_cache_size,
+                                4 * (self.tmaxz - self.tminz + 1) * 4 * self.tilesize * self.tilesize)
+                self.image_output = ImageOutput(self.options.tile_format, self.out_ds, self.tilesize,
+                                                                                self.options.resampling, self.in_nodata, self.store,
+                                                                                tile_cache_size, self.options.jpeg_quality,
+                                                                                self.options.creation_options, self.options.tile_ext,
+                                                                                self.options.write_threads)
+                self.image_output.mosaic = self.mosaic
+                self.image_output.cache_minz = self.tminz
+
+        # -------------------------------------------------------------------------
+        def close_input(self):
+                """Let the input datasets go and remove their warped VRTs from /vsimem/, these
+                would take the memory of every chart of a --batch until its end"""
+
+                self.in_ds = self.out_ds = self.mosaic = None
+                if self.image_output:
+                        self.image_output.out_ds = self.image_output.mosaic = None
+                # Removed once closed, a VRT is written out when it is closed
+                for path in self.vsimem_files:
+                        gdal.Unlink(path)
+                self.vsimem_files = []
+
+        # -------------------------------------------------------------------------
+        def warp_input(self):
+                """Warping of the input raster into the tile projection by gdal.Warp, the result
+                is a VRT in /vsimem/ warped on request with the --warp-* settings. Same as the
+                corrected AutoCreateWarpedVRT: NODATA kept if given, otherwise an alpha band
+                added to 1 and 3 band rasters (gdalwarp -dstalpha)."""
+
+                path = "/vsimem/gdal2tiles_%d.vrt" % os.getpid()
+                out_ds = gdal.Warp(path, self.in_ds, format='VRT', resampleAlg='near', **self.warp_settings())
+                if not out_ds:
+                        self.error("It is not possible to warp the input file '%s'." % self.input)
+                self.vsimem_files.append(path)
+
+                if self.in_nodata != []:
+                        out_ds.SetMetadataItem('NODATA_VALUES', " ".join(str(int(f)) for f in self.in_nodata))
+
+                return out_ds
+
+        # -------------------------------------------------------------------------
+        def warp_settings(self, in_ds=None, in_srs_wkt=None, in_nodata=None, dst_srs_wkt=None, alpha=False, cutline=None):
+                """Keyword arguments of gdal.Warp common to all the warps of the input, by default
+                those of the input raster. With alpha the NODATA is turned into the alpha band."""
+
+                if in_ds is None:
+                        in_ds, in_srs_wkt, in_nodata = self.in_ds, self.in_srs_wkt, self.in_nodata
+                        dst_srs_wkt = self.out_srs.ExportToWkt()
+                        if self.options.cutline and len(self.inputs) == 1:
+                                cutline = self.options.cutline[0]
+
+                warp_options = ['NUM_THREADS=%s' % self.options.warp_threads]
+                settings = dict(srcSRS=in_srs_wkt, dstSRS=dst_srs_wkt,
+                        multithread=True, warpOptions=warp_options,
+                        warpMemoryLimit=self.options.warp_memory * 1024 * 1024,
+                        errorThreshold=self.options.warp_error_threshold)
+
+                # Outside the cutline the pixels are NODATA or transparent
+                if cutline:
+                        settings.update(cutlineDSName=cutline)
+
+                if in_nodata != [] and alpha:
+                        warp_options += ['INIT_DEST=0', 'UNIFIED_SRC_NODATA=YES']
+                        settings.update(srcNodata=" ".join("%i" % v for v in in_nodata), dstAlpha=True)
+                elif in_nodata != []:
+                        nodata = " ".join("%i" % v for v in in_nodata)
+                        warp_options += ['INIT_DEST=NO_DATA', 'UNIFIED_SRC_NODATA=YES']
+                        settings.update(srcNodata=nodata, dstNodata=nodata)
+                elif in_ds.RasterCount in (1,3):
+                        warp_options.append('INIT_DEST=0')
+                        settings.update(dstAlpha=True)
+
+                return settings
+
+        # -------------------------------------------------------------------------
+        def open_mosaic(self):
+                """Open the inputs of --mosaic as one raster in the tile projection. Every input
+                is warped on its own, with an alpha band for its NODATA and collar. The warped
+                inputs are stacked in a VRT giving the extent and the pixel grid of the mosaic,
+                its pixels are composed query by query by the MosaicReader, with the first input
+                on top: where the charts overlap their tiles are composed once, in the order of
+                the inputs."""
+
+                if not hasattr(gdal, 'Warp'):
+                        self.error("The --mosaic option needs GDAL with gdal.Warp (GDAL 2.1 or newer).")
+
+                dst_srs = osr.SpatialReference()
+                if self.options.profile == 'mercator':
+                        dst_srs.ImportFromEPSG(900913)
+                else:
+                        dst_srs.ImportFromEPSG(4326)
+
+                self.mosaic_files = []
+                self.mosaic_sources = []
+                warped = []
+                bands = None
+                for i, path in enumerate(self.inputs):
+                        in_ds = gdal.Open(path, gdal.GA_ReadOnly)
+                        if not in_ds:
+                                self.error("It is not possible to open the input file '%s'." % path)
+                        if in_ds.GetRasterBand(1).GetRasterColorTable():
+                                self.error("Please convert '%s' to RGB/RGBA and run gdal2tiles on the result." % path,
+                                           "gdal_translate -of vrt -expand rgba %s temp.vrt" % path)
+                        self.mosaic_files += in_ds.GetFileList() or [path]
+
+                        if self.options.s_srs:
+                                srs = osr.SpatialReference()
+                                srs.SetFromUserInput(self.options.s_srs)
+                                in_srs_wkt = srs.ExportToWkt()
+                        else:
+                                in_srs_wkt = in_ds.GetProjection() or in_ds.GetGCPProjection()
+                        if not in_srs_wkt:
+                                self.error("Input file '%s' has unknown SRS." % path, "Use --s_srs ESPG:xyz (or similar) to provide source reference system.")
+
+                        if self.options.srcnodata:
+                                nds = map( float, self.options.srcnodata.split(','))
+                                in_nodata = (nds * in_ds.RasterCount)[:in_ds.RasterCount]
+                        else:
+                                in_nodata = [in_ds.GetRasterBand(b).GetNoDataValue() for b in range(1, in_ds.RasterCount+1)]
+                                if None in in_nodata:
+                                        in_nodata = []
+
+                        cutline = None
+                        if self.options.cutline:
+                                cutline = self.options.cutline[i % len(self.options.cutline)]
+
+                        vrt_path = "/vsimem/gdal2tiles_%d_%d.vrt" % (os.getpid(), i)
+                        out_ds = gdal.Warp(vrt_path, in_ds, format='VRT',
+                                           resampleAlg='near', **self.warp_settings(in_ds, in_srs_wkt, in_nodata, dst_srs.ExportToWkt(), True, cutline))
+                        if not out_ds:
+                                self.error("It is not possible to warp the input file '%s'." % path)
+                        self.vsimem_files.append(vrt_path)
+                        if bands is None:
+                                bands = out_ds.RasterCount
+                        elif out_ds.RasterCount != bands:
+                                self.error("The --mosaic inputs must have the same number of bands, '%s' has not." % path)
+                        warped.append(out_ds)
+                        self.mosaic_sources.append((in_ds, in_srs_wkt, in_nodata))
+
+                # Only the extent, grid and bands of the VRT are used: its sources would overwrite
+                # each other, alpha 0 included (VRT sources honour their mask from GDAL 3.3 only)
+                vrt_path = "/vsimem/gdal2tiles_%d_mosaic.vrt" % os.getpid()
+                mosaic_ds = gdal.BuildVRT(vrt_path, warped, resolution='highest')
+                if not mosaic_ds:
+                        self.error("It is not possible to build the mosaic of the input files.")
+                self.vsimem_files.append(vrt_path)
+
+                # The warper draws the later inputs over the earlier ones, through their alpha band
+                warped.reverse()
+                self.mosaic = MosaicReader(warped, mosaic_ds, dst_srs.ExportToWkt(), self.options.warp_threads)
+                return mosaic_ds
+
+        # -------------------------------------------------------------------------
+        def open_cutline(self):
+                """Read the polygons of the --cutline datasources into one geometry in the tile
+                projection and crop the tile ranges of all the zoom levels to its envelope.
+                A cutline without SRS is in the SRS of the input it clips, as for the warper:
+                every input of a --mosaic with its own cutline or the common one."""
+
+                if len(self.inputs) > 1:
+                        cutlines = []
+                        for i, (in_ds, in_srs_wkt, in_nodata) in enumerate(self.mosaic_sources):
+                                in_srs = osr.SpatialReference()
+                                in_srs.ImportFromWkt(in_srs_wkt)
+                                cutlines.append((self.options.cutline[i % len(self.options.cutline)], in_srs))
+                else:
+                        cutlines = [(source, self.in_srs) for source in self.options.cutline]
+
+                geom = ogr.Geometry(ogr.wkbMultiPolygon)
+                for source, in_srs in cutlines:
+                        ds = ogr.Open(source)
+                        if not ds:
+                                self.error("It is not possible to open the cutline '%s'." % source)
+                        layer = ds.GetLayer(0)
+                        srs = layer.GetSpatialRef() or in_srs
+                        transform = None
+                        if srs and srs.ExportToProj4() != self.out_srs.ExportToProj4():
+                                transform = coordinate_transformation(srs, self.out_srs)
+                        for feature in layer:
+                                g = feature.GetGeometryRef()
+                                if g is None:
+                                        continue
+                                g = g.Clone()
+                                if transform:
+                                        g.Transform(transform)
+                                geom = geom.Union(g)
+                        ds = None
+
+                if geom.IsEmpty():
+                        self.error("The cutline '%s' has no polygon." % "', '".join(self.options.cutline))
+
+                if self.options.profile == 'mercator':
+                        to_tile = self.mercator.MetersToTile
+                else:
+                        to_tile = self.geodetic.LatLonToTile
+                minx, maxx, miny, maxy = geom.GetEnvelope()
+                for tz in range(0, 32):
+                        tminx, tminy, tmaxx, tmaxy = self.tminmax[tz]
+                        cminx, cminy = to_tile(minx, miny, tz)
+                        cmaxx, cmaxy = to_tile(maxx, maxy, tz)
+                        self.tminmax[tz] = (max(tminx, cminx), max(tminy, cminy), min(tmaxx, cmaxx), min(tmaxy, cmaxy))
+                tminx, tminy, tmaxx, tmaxy = self.tminmax[self.tmaxz]
+                if tminx > tmaxx or tminy > tmaxy:
+                        self.error("The cutline does not overlap the input raster.")
+
+                return geom
+
+        # -------------------------------------------------------------------------
+        def find_coverage(self):
+                """Find the tiles with valid pixels of the input from one read of its mask (or of
+                its bands against the NODATA) at about 8 x 8 samples per base tile. Every valid
+                sample marks the tiles under it and its neighbours, for the resampling and the
+                warp. Returns the sets of (tx, ty) tiles by zoom level, None if not known."""
+
+                if self.options.profile == 'mercator':
+                        to_tile = self.mercator.MetersToTile
+                else:
+                        to_tile = self.geodetic.LatLonToTile
+
+                tz = self.tmaxz
+                tminx, tminy, tmaxx, tmaxy = self.tminmax[tz]
+                samples = 8
+
+                if len(self.inputs) > 1:
+                        sources = self.mosaic_sources
+                else:
+                        sources = [(self.in_ds, self.in_srs_wkt, self.in_nodata)]
+
+                covered = set()
+                for in_ds, in_srs_wkt, in_nodata in sources:
+                        gt = in_ds.GetGeoTransform()
+                        if in_ds.GetGCPCount() != 0 or gt == (0.0, 1.0, 0.0, 0.0, 0.0, 1.0):
+                                return None
+
+                        xsize, ysize = in_ds.RasterXSize, in_ds.RasterYSize
+                        bufx = min(xsize, samples * (tmaxx - tminx + 1))
+                        bufy = min(ysize, samples * (tmaxy - tminy + 1))
+
+                        if in_nodata != []:
+                                valid = [False] * (bufx * bufy)
+                                for i, nodata in enumerate(in_nodata):
+                                        data = in_ds.GetRasterBand(i+1).ReadRaster(0, 0, xsize, ysize, bufx, bufy, gdal.GDT_Float64)
+                                        for j, value in enumerate(array.array('d', data)):
+                                                if value != nodata:
+                                                        valid[j] = True
+                        else:
+                                valid = bytearray(in_ds.GetRasterBand(1).GetMaskBand().ReadRaster(0, 0, xsize, ysize, bufx, bufy))
+
+                        # Tiles of the corners of the samples
+                        sx, sy = xsize / float(bufx), ysize / float(bufy)
+                        points = [(gt[0] + i*sx*gt[1] + j*sy*gt[2], gt[3] + i*sx*gt[4] + j*sy*gt[5])
+                                  for j in range(bufy+1) for i in range(bufx+1)]
+                        if in_srs_wkt:
+                                srs = osr.SpatialReference()
+                                srs.ImportFromWkt(in_srs_wkt)
+                                if srs.ExportToProj4() != self.out_srs.ExportToProj4():
+                                        points = coordinate_transformation(srs, self.out_srs).TransformPoints(points)
+                        corners = [to_tile(p[0], p[1], tz) for p in points]
+
+                        for j in range(bufy):
+                                for i in range(bufx):
+                                        if not valid[j*bufx + i]:
+                                                continue
+                                        i0, i1 = max(0, i-1), min(bufx, i+2)
+                                        j0, j1 = max(0, j-1), min(bufy, j+2)
+                                        c = [corners[cj*(bufx+1) + ci] for cj in (j0, j1) for ci in (i0, i1)]
+                                        for ty in range(max(tminy, min(t[1] for t in c)), min(tmaxy, max(t[1] for t in c))+1):
+                                                for tx in range(max(tminx, min(t[0] for t in c)), min(tmaxx, max(t[0] for t in c))+1):
+                                                        covered.add((tx, ty))
+
+                if not covered:
+                        return None
+
+                coverage = {tz: covered}
+                for z in range(tz-1, self.tminz-1, -1):
+                        coverage[z] = set((tx >> 1, ty >> 1) for tx, ty in coverage[z+1])
+
+                if self.options.verbose:
+                        print "Base tiles with valid pixels: %d of %d" % (len(covered), (tmaxx-tminx+1) * (tmaxy-tminy+1))
+
+                return coverage
+
+        # -------------------------------------------------------------------------
+        def is_empty_tile(self, tx, ty, tz):
+                """Is the tile left empty, outside the --cutline or with no valid pixel of the input?"""
+
+                if self.coverage is not None and (tx, ty) not in self.coverage[tz]:
+                        return True
+                return self.outside_cutline(tx, ty, tz)
+
+        # -------------------------------------------------------------------------
+        def write_empty_tiles(self):
+                """List the empty tiles of the zoom levels generated in 'empty.txt', as z/x/y lines"""
+
+                lines = []
+                for tz in range(self.tminz, self.tmaxz+1):
+                        tminx, tminy, tmaxx, tmaxy = self.tminmax[tz]
+                        for ty in range(tminy, tmaxy+1):
+                                for tx in range(tminx, tmaxx+1):
+                                        if self.is_empty_tile(tx, ty, tz):
+                                                lines.append("%d/%d/%d\n" % (tz, tx, ty))
+                self.store.write_file('empty.txt', "".join(lines))
+
+        # -------------------------------------------------------------------------
+        def outside_cutline(self, tx, ty, tz):
+                """Is the tile entirely outside the --cutline?"""
+
+                if self.cutline_geom is None:
+                        return False
+                if self.options.profile == 'mercator':
+                        b = self.mercator.TileBounds(tx, ty, tz)
+                else:
+                        b = self.geodetic.TileBounds(tx, ty, tz)
+                ring = ogr.Geometry(ogr.wkbLinearRing)
+                for x, y in ((b[0], b[1]), (b[2], b[1]), (b[2], b[3]), (b[0], b[3]), (b[0], b[1])):
+                        ring.AddPoint_2D(x, y)
+                tile = ogr.Geometry(ogr.wkbPolygon)
+                tile.AddGeometry(ring)
+                return not self.cutline_geom.Intersects(tile)
+
+        # -------------------------------------------------------------------------
+        def open_warp_cache(self):
+                """Open the warped intermediate of --warp-cache: the input warped once into a
+                tiled GeoTIFF covering the base tiles, one pixel of it per pixel of the base
+                tiles. It is created on the first run, keyed by the checksum of the input
+                files and all the settings affecting its pixels."""
+
+                if not hasattr(gdal, 'Warp'):
+                        self.error("The --warp-cache option needs GDAL with gdal.Warp (GDAL 2.1 or newer).")
+
+                if self.options.profile == 'mercator':
+                        tile_bounds = self.mercator.TileBounds
+                else:
+                        tile_bounds = self.geodetic.TileBounds
+                tminx, tminy, tmaxx, tmaxy = self.tminmax[self.tmaxz]
+                bmin = tile_bounds(tminx, tminy, self.tmaxz)
+                bmax = tile_bounds(tmaxx, tmaxy, self.tmaxz)
+                res = (bmin[2] - bmin[0]) / self.tilesize
+
+                # The resampling of the query is done by the warper already, with its nearest
+                # algorithm for those it has not
+                resample_alg = self.options.resampling
+                if resample_alg == 'antialias':
+                        resample_alg = 'lanczos'
+                elif resample_alg == 'box':
+                        resample_alg = 'average'
+
+                if self.warp_cache_file is None:
+                        key = hashlib.md5()
+                        for filename in self.input_files + [f for f in self.options.cutline or [] if os.path.isfile(f)]:
+                                f = open(filename, 'rb')
+                                for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                                        key.update(chunk)
+                                f.close()
+                        key.update(repr((self.inputs, self.options.cutline, self.options.profile, self.tilesize, self.tminz, self.tmaxz, self.in_nodata,
+                                         self.in_srs_wkt, resample_alg, self.options.warp_error_threshold)))
+                        self.warp_cache_file = os.path.join(self.options.warp_cache, "%s-%s.tif" % (
+                                os.path.splitext(os.path.basename(self.input))[0], key.hexdigest()))
+
+                if not os.path.exists(self.warp_cache_file):
+                        if self.options.verbose:
+                                print "Warping of the raster into", self.warp_cache_file
+                        ensure_dir_exists(self.warp_cache_file)
+                        # Written under a temporary name, a broken warp must not be taken for the cached one
+                        tempfilename = "%s.%d.tmp" % (self.warp_cache_file, os.getpid())
+                        settings = self.warp_settings()
+                        if self.mosaic:
+                                # The warped inputs composed through their alpha bands, as by the MosaicReader
+                                sources = self.mosaic.sources
+                                settings.update(srcAlpha=True, dstAlpha=True)
+                        else:
+                                sources = self.in_ds
+                        ds = gdal.Warp(tempfilename, sources, format='GTiff',
+                                outputBounds=(bmin[0], bmin[1], bmax[2], bmax[3]), xRes=res, yRes=res,
+                                resampleAlg=resample_alg,
+                                creationOptions=['TILED=YES', 'BLOCKXSIZE=%d' % self.tilesize, 'BLOCKYSIZE=%d' % self.tilesize,
+                                                 'COMPRESS=DEFLATE', 'PREDICTOR=2', 'BIGTIFF=IF_SAFER'],
+                                **settings)
+                        if not ds:
+                                self.error("It is not possible to warp the input file '%s'." % self.input)
+                        ds = None
+                        os.rename(tempfilename, self.warp_cache_file)
+                elif self.options.verbose:
+                        print "Warped raster reused from", self.warp_cache_file
+
+                return gdal.Open(self.warp_cache_file, gdal.GA_ReadOnly)
+
+        # -------------------------------------------------------------------------
+        def find_dirty_tiles(self):
+                """Compare the input with the previous edition block by block in the source
+                pixels and return the sets of (tx, ty) tiles covering the changed blocks by
+                zoom level, the base tiles widened by one tile for the resampling and the
+                warp. None (everything dirty) if the editions are not georeferenced alike."""
+
+                prev_ds = gdal.Open(self.options.previous, gdal.GA_ReadOnly)
+                if not prev_ds:
+                        self.error("It is not possible to open the previous edition '%s'." % self.options.previous)
+
+                if ((prev_ds.RasterXSize, prev_ds.RasterYSize, prev_ds.RasterCount, prev_ds.GetGeoTransform(), prev_ds.GetProjection())
+                        != (self.in_ds.RasterXSize, self.in_ds.RasterYSize, self.in_ds.RasterCount, self.in_ds.GetGeoTransform(), self.in_ds.GetProjection())
+                        or self.in_ds.GetGCPCount() != 0):
+                        print "The previous edition is not georeferenced the same way, all the tiles are generated."
+                        return None
+
+                if self.options.profile == 'mercator':
+                        to_tile = self.mercator.MetersToTile
+                else:
+                        to_tile = self.geodetic.LatLonToTile
+
+                transform = None
+                if self.in_srs and self.in_srs.ExportToProj4() != self.out_srs.ExportToProj4():
+                        transform = coordinate_transformation(self.in_srs, self.out_srs)
+
+                gt = self.in_ds.GetGeoTransform()
+                tz = self.tmaxz
+                tminx, tminy, tmaxx, tmaxy = self.tminmax[tz]
+                xsize, ysize = self.in_ds.RasterXSize, self.in_ds.RasterYSize
+                step = 256
+
+                dirty = set()
+                for y in range(0, ysize, step):
+                        for x in range(0, xsize, step):
+                                w, h = min(step, xsize-x), min(step, ysize-y)
+                                if self.in_ds.ReadRaster(x, y, w, h) == prev_ds.ReadRaster(x, y, w, h):
+                                        continue
+                                # Corners and edge midpoints of the block, the edges bend in the warp
+                                txs, tys = [], []
+                                for px in (x, x+w/2.0, x+w):
+                                        for py in (y, y+h/2.0, y+h):
+                                                gx = gt[0] + px*gt[1] + py*gt[2]
+                                                gy = gt[3] + px*gt[4] + py*gt[5]
+                                                if transform:
+                                                        gx, gy = transform.TransformPoint(gx, gy)[:2]
+                                                ttx, tty = to_tile(gx, gy, tz)
+                                                txs.append(ttx)
+                                                tys.append(tty)
+                                for ty in range(max(tminy, min(tys)-1), min(tmaxy, max(tys)+1)+1):
+                                        for tx in range(max(tminx, min(txs)-1), min(tmaxx, max(txs)+1)+1):
+                                                dirty.add((tx, ty))
+
+                dirty_tiles = {tz: dirty}
+                for z in range(tz-1, self.tminz-1, -1):
+                        dirty_tiles[z] = set((tx >> 1, ty >> 1) for tx, ty in dirty_tiles[z+1])
+
+                if self.options.verbose:
+                        print "Changed base tiles since the previous edition:", len(dirty)
+
+                return dirty_tiles
+
+        # -------------------------------------------------------------------------
+        def copy_previous_tile(self, tx, ty, tz):
+                """Take the tile over from the previous edition's output if it did not change.
+                Returns False if the tile has to be generated."""
+
+                if self.dirty_tiles is None or (tx, ty) in self.dirty_tiles[tz]:
+                        return False
+                return self.image_output.import_tile(self.previous_store, tx, ty, tz)
+
+        # -------------------------------------------------------------------------
+        def worker_state(self):
+                """Attributes of the tiler set up in the main process once and handed on to the
+                worker processes instead of being set up again in each of them"""
+
+                return {'warp_cache_file': self.warp_cache_file, 'dirty_tiles': self.dirty_tiles, 'coverage': self.coverage}
+
         # -------------------------------------------------------------------------
         def generate_metadata(self):
                 """Generation of main metadata files and HTML viewers (metadata related to particular tiles are generated during the tile processing)."""
-                
-                if not os.path.exists(self.output):
-                        os.makedirs(self.output)
 
                 if self.options.profile == 'mercator':
                         
@@ -1012,17 +1892,13 @@ gdal2tiles temp.vrt""" % self.input )
 
                         # Generate googlemaps.html
                         if self.options.webviewer in ('all','google') and self.options.profile == 'mercator':
-                                if not self.options.resume or not os.path.exists(os.path.join(self.output, 'googlemaps.html')):
-                                        f = open(os.path.join(self.output, 'googlemaps.html'), 'w')
-                                        f.write( self.generate_googlemaps() )
-                                        f.close()
+                                if not self.options.resume or not self.store.file_exists('googlemaps.html'):
+                                        self.store.write_file('googlemaps.html', self.generate_googlemaps())
 
                         # Generate openlayers.html
                         if self.options.webviewer in ('all','openlayers'):
-                                if not self.options.resume or not os.path.exists(os.path.join(self.output, 'openlayers.html')):
-                                        f = open(os.path.join(self.output, 'openlayers.html'), 'w')
-                                        f.write( self.generate_openlayers() )
-                                        f.close()
+                                if not self.options.resume or not self.store.file_exists('openlayers.html'):
+                                        self.store.write_file('openlayers.html', self.generate_openlayers())
 
                 elif self.options.profile == 'geodetic':
                         
@@ -1034,10 +1910,8 @@ gdal2tiles temp.vrt""" % self.input )
                         
                         # Generate openlayers.html
                         if self.options.webviewer in ('all','openlayers'):
-                                if not self.options.resume or not os.path.exists(os.path.join(self.output, 'openlayers.html')):
-                                        f = open(os.path.join(self.output, 'openlayers.html'), 'w')
-                                        f.write( self.generate_openlayers() )
-                                        f.close()                       
+                                if not self.options.resume or not self.store.file_exists('openlayers.html'):
+                                        self.store.write_file('openlayers.html', self.generate_openlayers())
 
                 elif self.options.profile == 'raster':
                         
@@ -1048,18 +1922,37 @@ gdal2tiles temp.vrt""" % self.input )
                         
                         # Generate openlayers.html
                         if self.options.webviewer in ('all','openlayers'):
-                                if not self.options.resume or not os.path.exists(os.path.join(self.output, 'openlayers.html')):
-                                        f = open(os.path.join(self.output, 'openlayers.html'), 'w')
-                                        f.write( self.generate_openlayers() )
-                                        f.close()                       
+                                if not self.options.resume or not self.store.file_exists('openlayers.html'):
+                                        self.store.write_file('openlayers.html', self.generate_openlayers())
 
 
                 # Generate tilemapresource.xml.
                 if (self.options.tile_format != 'hybrid' and self.options.profile != 'gearth'
-                        and (not self.options.resume or not os.path.exists(os.path.join(self.output, 'tilemapresource.xml')))):
-                        f = open(os.path.join(self.output, 'tilemapresource.xml'), 'w')
-                        f.write( self.generate_tilemapresource())
-                        f.close()
+                        and (not self.options.resume or not self.store.file_exists('tilemapresource.xml'))):
+                        self.store.write_file('tilemapresource.xml', self.generate_tilemapresource())
+
+                # Description of the tile set for the stores keeping one (MBTiles)
+                metadata = {
+                        'name': self.options.title,
+                        'type': 'overlay',
+                        'version': '1.1',
+                        'description': self.options.title,
+                        'format': format_extension[self.image_output.image_formats[0]],
+                        'minzoom': str(self.tminz),
+                        'maxzoom': str(self.tmaxz)}
+                if self.options.profile in ('mercator', 'geodetic'):
+                        metadata['bounds'] = "%.8f,%.8f,%.8f,%.8f" % (self.swne[1], self.swne[0], self.swne[3], self.swne[2])
+                self.store.write_metadata(metadata)
+
+                # Additional files stored with the tiles
+                for add_file in self.options.add_files or []:
+                        src, name = (add_file.split('=', 1) + [None])[:2]
+                        if not name:
+                                name = os.path.basename(src)
+                        if not self.options.resume or not self.store.file_exists(name):
+                                f = open(src, 'rb')
+                                self.store.write_file(name, f.read())
+                                f.close()
 
         # -------------------------------------------------------------------------
         def generate_base_tiles(self):
@@ -1079,7 +1972,6 @@ gdal2tiles temp.vrt""" % self.input )
 
                 # Set the bounds
                 tminx, tminy, tmaxx, tmaxy = self.tminmax[self.tmaxz]
-                querysize = self.querysize
 
                 # Just the center tile
                 #tminx = tminx+ (tmaxx - tminx)/2
@@ -1090,88 +1982,220 @@ gdal2tiles temp.vrt""" % self.input )
                 #print tminx, tminy, tmaxx, tmaxy
                 tcount = (1+abs(tmaxx-tminx)) * (1+abs(tmaxy-tminy))
                 #print tcount
+
+                if self.options.processes > 1:
+                        self.run_parallel(base_tiles_worker, self.iter_base_batches(), tcount)
+                        return
+
                 ti = 0
                 
+                for bx, by, size, tz in self.iter_base_blocks():
+
+                        if self.stopped:
+                                break
+
+                        try:
+                                ti += self.generate_base_block(bx, by, size, tz)
+                        except ImageOutputException, e:
+                                self.error(e.message)
+
+                        if self.options.verbose:
+                                print ti,'/',tcount
+                        self.report_progress( ti / float(tcount) )
+
+        # -------------------------------------------------------------------------
+        def iter_base_blocks(self):
+                """Generate the metatile blocks (bx, by, size, tz) covering the base tiles,
+                from the top row down. Without --metatile every block is one tile."""
+
+                tminx, tminy, tmaxx, tmaxy = self.tminmax[self.tmaxz]
+                shift = self.metatile_shift
+                size = 1 << shift
+
+                for by in range(tmaxy >> shift << shift, (tminy >> shift << shift) - 1, -size):
+                        for bx in range(tminx >> shift << shift, tmaxx+1, size):
+                                yield bx, by, size, self.tmaxz
+
+        # -------------------------------------------------------------------------
+        def iter_base_batches(self):
+                """Split the base tile blocks into batches of about TILE_BATCH_SIZE tiles for the worker processes"""
+
+                batch_size = max(1, TILE_BATCH_SIZE >> (2 * self.metatile_shift))
+
+                batch = []
+                for block in self.iter_base_blocks():
+                        batch.append(block)
+                        if len(batch) == batch_size:
+                                yield batch
+                                batch = []
+                if batch:
+                        yield batch
+
+        # -------------------------------------------------------------------------
+        def generate_base_block(self, bx, by, size, tz):
+                """Generation of the base tiles of the square block of size x size tiles with the
+                lower left tile bx, by, from one query resampled at once. Returns the number of
+                tiles of the block within the bounds (skipped ones included)."""
+
+                tminx, tminy, tmaxx, tmaxy = self.tminmax[tz]
+                tiles = [(tx, ty) for ty in range(min(by+size-1, tmaxy), max(by, tminy)-1, -1)
+                                  for tx in range(max(bx, tminx), min(bx+size-1, tmaxx)+1)]
+                count = len(tiles)
+
+                tiles = [(tx, ty) for tx, ty in tiles if not self.is_empty_tile(tx, ty, tz)]
+
+                if self.options.resume:
+                        tiles = [(tx, ty) for tx, ty in tiles if not self.image_output.tile_exists(tx, ty, tz)]
+                        if self.options.verbose and len(tiles) < count:
+                                print "Tile generation skiped because of --resume"
+
+                if self.dirty_tiles is not None:
+                        tiles = [(tx, ty) for tx, ty in tiles if not self.copy_previous_tile(tx, ty, tz)]
+
+                if size == 1 or len(tiles) <= 1 or self.options.profile not in ('mercator','geodetic'):
+                        for tx, ty in tiles:
+                                try:
+                                        self.generate_base_tile(tx, ty, tz)
+                                except ImageOutputException, e:
+                                        raise ImageOutputException("'%d/%d/%d': %s" % (tz, tx, ty, e.message))
+                        return count
+
+                if self.options.profile == 'mercator':
+                        bmin = self.mercator.TileBounds(bx, by, tz)
+                        bmax = self.mercator.TileBounds(bx+size-1, by+size-1, tz)
+                else:
+                        bmin = self.geodetic.TileBounds(bx, by, tz)
+                        bmax = self.geodetic.TileBounds(bx+size-1, by+size-1, tz)
+
+                querysize = self.querysize * size
+                rb, wb = self.geo_query( self.out_ds, bmin[0], bmax[3], bmax[2], bmin[1], querysize=querysize)
+                xyzzy = Xyzzy(querysize, *(rb + wb))
+
+                if self.options.verbose:
+                        print "\tMetatile ReadRaster Extent: ", rb, wb
+
+                try:
+                        self.image_output.write_base_block(bx, by, size, tz, tiles, xyzzy)
+                except ImageOutputException, e:
+                        raise ImageOutputException("'%d/%d-%d/%d-%d': %s" % (tz, bx, bx+size-1, by, by+size-1, e.message))
+                return count
+
+        # -------------------------------------------------------------------------
+        def generate_base_tile(self, tx, ty, tz):
+                """Generation of one base tile directly from the input raster"""
+
+                #print "\tgdalwarp -ts 512 512 -te %s %s %s %s %s %s_%s_%s.tif" % ( b[0], b[1], b[2], b[3], "tiles.vrt", tz, tx, ty)
+
+                # Don't scale up by nearest neighbour, better change the querysize
+                # to the native resolution (and return smaller query tile) for scaling
+
                 ds = self.out_ds
-                tz = self.tmaxz
-                for ty in range(tmaxy, tminy-1, -1): #range(tminy, tmaxy+1):
-                        for tx in range(tminx, tmaxx+1):
+                querysize = self.querysize
 
-                                if self.stopped:
-                                        break
-                                ti += 1
+                if self.options.profile in ('mercator','geodetic'):
+                        if self.options.profile == 'mercator':
+                                # Tile bounds in EPSG:900913
+                                b = self.mercator.TileBounds(tx, ty, tz)
+                        elif self.options.profile == 'geodetic':
+                                b = self.geodetic.TileBounds(tx, ty, tz)
 
-                                #print "\tgdalwarp -ts 512 512 -te %s %s %s %s %s %s_%s_%s.tif" % ( b[0], b[1], b[2], b[3], "tiles.vrt", tz, tx, ty)
+                        rb, wb = self.geo_query( ds, b[0], b[3], b[2], b[1])
+                        nativesize = wb[0]+wb[2] # Pixel size in the raster covering query geo extent
+                        if self.options.verbose:
+                                print "\tNative Extent (querysize",nativesize,"): ", rb, wb
 
-                                # Don't scale up by nearest neighbour, better change the querysize
-                                # to the native resolution (and return smaller query tile) for scaling
+                        # Tile bounds in raster coordinates for ReadRaster query
+                        rb, wb = self.geo_query( ds, b[0], b[3], b[2], b[1], querysize=querysize)
 
-                                if self.options.profile in ('mercator','geodetic'):
-                                        if self.options.profile == 'mercator':
-                                                # Tile bounds in EPSG:900913
-                                                b = self.mercator.TileBounds(tx, ty, tz)
-                                        elif self.options.profile == 'geodetic':
-                                                b = self.geodetic.TileBounds(tx, ty, tz)
+                        rx, ry, rxsize, rysize = rb
+                        wx, wy, wxsize, wysize = wb
+                else: # 'raster' or 'gearth' profile:
+                        
+                        tmaxx, tmaxy = self.tminmax[tz][2:]
+                        tsize = int(self.tsize[tz]) # tilesize in raster coordinates for actual zoom
+                        xsize = self.out_ds.RasterXSize # size of the raster in pixels
+                        ysize = self.out_ds.RasterYSize
+                        if tz >= self.nativezoom:
+                                querysize = self.tilesize # int(2**(self.nativezoom-tz) * self.tilesize)
+
+                        rx = (tx) * tsize
+                        rxsize = 0
+                        if tx == tmaxx:
+                                rxsize = xsize % tsize
+                        if rxsize == 0:
+                                rxsize = tsize
+                        
+                        rysize = 0
+                        if ty == tmaxy:
+                                rysize = ysize % tsize
+                        if rysize == 0:
+                                rysize = tsize
+                        ry = ysize - (ty * tsize) - rysize
 
-                                        rb, wb = self.geo_query( ds, b[0], b[3], b[2], b[1])
-                                        nativesize = wb[0]+wb[2] # Pixel size in the raster covering query geo extent
-                                        if self.options.verbose:
-                                                print "\tNative Extent (querysize",nativesize,"): ", rb, wb
+                        wx, wy = 0, 0
+                        wxsize, wysize = int(rxsize/float(tsize) * self.tilesize), int(rysize/float(tsize) * self.tilesize)
+                        if wysize != self.tilesize:
+                                wy = self.tilesize - wysize
 
-                                        querysize = self.querysize
-                                        # Tile bounds in raster coordinates for ReadRaster query
-                                        rb, wb = self.geo_query( ds, b[0], b[3], b[2], b[1], querysize=querysize)
+                xyzzy = Xyzzy(querysize, rx, ry, rxsize, rysize, wx, wy, wxsize, wysize)
 
-                                        rx, ry, rxsize, rysize = rb
-                                        wx, wy, wxsize, wysize = wb
-                                else: # 'raster' or 'gearth' profile:
-                                        
-                                        tsize = int(self.tsize[tz]) # tilesize in raster coordinates for actual zoom
-                                        xsize = self.out_ds.RasterXSize # size of the raster in pixels
-                                        ysize = self.out_ds.RasterYSize
-                                        if tz >= self.nativezoom:
-                                                querysize = self.tilesize # int(2**(self.nativezoom-tz) * self.tilesize)
-
-                                        rx = (tx) * tsize
-                                        rxsize = 0
-                                        if tx == tmaxx:
-                                                rxsize = xsize % tsize
-                                        if rxsize == 0:
-                                                rxsize = tsize
-                                        
-                                        rysize = 0
-                                        if ty == tmaxy:
-                                                rysize = ysize % tsize
-                                        if rysize == 0:
-                                                rysize = tsize
-                                        ry = ysize - (ty * tsize) - rysize
-
-                                        wx, wy = 0, 0
-                                        wxsize, wysize = int(rxsize/float(tsize) * self.tilesize), int(rysize/float(tsize) * self.tilesize)
-                                        if wysize != self.tilesize:
-                                                wy = self.tilesize - wysize
-
-                                xyzzy = Xyzzy(querysize, rx, ry, rxsize, rysize, wx, wy, wxsize, wysize)
-
-                                if self.options.resume:
-                                        exists = self.image_output.tile_exists(tx, ty, tz)
-                                        if exists and self.options.verbose:
-                                                print "Tile generation skiped because of --resume"
-                                else:
-                                        exists = False
+                if self.options.resume and self.image_output.tile_exists(tx, ty, tz):
+                        if self.options.verbose:
+                                print "Tile generation skiped because of --resume"
+                        return
 
-                                if not exists:
-                                        try:
-                                                if self.options.verbose:
-                                                        print ti,'/',tcount
-                                                        print "\tReadRaster Extent: ", (rx, ry, rxsize, rysize), (wx, wy, wxsize, wysize)
+                if self.options.verbose:
+                        print "\tReadRaster Extent: ", (rx, ry, rxsize, rysize), (wx, wy, wxsize, wysize)
 
-                                                self.image_output.write_base_tile(tx, ty, tz, xyzzy)
-                                        except ImageOutputException, e:
-                                                self.error("'%d/%d/%d': %s" % (tz, tx, ty, e.message))
+                self.image_output.write_base_tile(tx, ty, tz, xyzzy)
+
+        # -------------------------------------------------------------------------
+        def run_parallel(self, worker, batches, tcount):
+                """Feed the batches to a pool of worker processes, each with its own
+                copy of the input raster, and report the progress of the results.
+                The workers return the number of tiles they processed, the total is returned.
+
+                The pool is the shared one of a --batch, or one of its own. Every batch goes
+                with the job: the state file of the tiler and its arguments, the workers set
+                up their copy of the tiler on the first batch of a new job."""
+
+                import multiprocessing
+
+                # The workers must see every tile written so far
+                self.image_output.flush()
 
-                                if not self.options.verbose:
-                                        self.progressbar( ti / float(tcount) )
+                fd, state_file = tempfile.mkstemp('-gdal2tiles.state')
+                f = os.fdopen(fd, 'wb')
+                cPickle.dump(self.worker_state(), f, 2)
+                f.close()
+                job = (state_file, self.arguments)
+
+                pool = self.pool or multiprocessing.Pool(self.options.processes)
+                ti = 0
+                try:
+                        # chunksize=1: every idle worker pulls the next batch from the shared
+                        # task queue, so the slow (dense) parts of the chart don't stall the others
+                        for count, stats in pool.imap_unordered(worker, ((job, batch) for batch in batches), 1):
+                                ti += count
+                                STATS.merge(stats)
+                                self.report_progress( ti / float(tcount) )
+                                if self.stopped:
+                                        break
+                except ImageOutputException, e:
+                        pool.terminate()
+                        os.unlink(state_file)
+                        self.error(e.message)
+
+                if self.stopped:
+                        pool.terminate()
+                        pool.join()
+                elif pool is not self.pool:
+                        pool.close()
+                        pool.join()
+                os.unlink(state_file)
+                # Learn about the tiles written by the workers
+                self.store.refresh()
+                return ti
 
         # -------------------------------------------------------------------------
         def generate_overview_tiles(self):
@@ -1187,10 +2211,27 @@ gdal2tiles temp.vrt""" % self.input )
                         tcount += (1+abs(tmaxx-tminx)) * (1+abs(tmaxy-tminy))
 
                 ti = 0
-                
+                topz = self.tmaxz-1
+
+                if self.options.processes > 1 and self.tmaxz > self.tminz:
+                        # Every worker builds the whole quadtree below one tile of the split
+                        # level, only the few tiles above it are generated after the join
+                        splitz = self.get_split_zoom()
+                        tminx, tminy, tmaxx, tmaxy = self.tminmax[splitz]
+                        roots = [(tx, ty, splitz) for ty in range(tmaxy, tminy-1, -1) for tx in range(tminx, tmaxx+1)]
+                        ti = self.run_parallel(overview_subtree_worker, roots, tcount)
+                        topz = splitz-1
+
+                self.generate_overview_levels(topz, ti, tcount)
+
+        # -------------------------------------------------------------------------
+        def generate_overview_levels(self, topz, ti, tcount):
+                """Generation of the overview tiles level by level, from the level topz up to the
+                minimal zoom level. The progress continues from ti of tcount tiles."""
+
                 # querysize = tilesize * 2
 
-                for tz in range(self.tmaxz-1, self.tminz-1, -1):
+                for tz in range(topz, self.tminz-1, -1):
 
                         tminx, tminy, tmaxx, tmaxy = self.tminmax[tz]
                         for ty in range(tmaxy, tminy-1, -1): #range(tminy, tmaxy+1):
@@ -1201,43 +2242,211 @@ gdal2tiles temp.vrt""" % self.input )
                                                 
                                         ti += 1
 
-                                        if self.options.resume:
-                                                exists = self.image_output.tile_exists(tx, ty, tz)
-                                                if exists and self.options.verbose:
-                                                        print "Tile generation skiped because of --resume"
-                                        else:
-                                                exists = False
+                                        if self.options.verbose:
+                                                print ti,'/',tcount
 
-                                        if not exists:
-                                                try:
-                                                        if self.options.verbose:
-                                                                print ti,'/',tcount
-                                                                print "\tbuild from zoom", tz+1," tiles:", (2*tx, 2*ty), (2*tx+1, 2*ty),(2*tx, 2*ty+1), (2*tx+1, 2*ty+1)
+                                        try:
+                                                self.generate_overview_tile(tx, ty, tz)
+                                        except Exception, e:
+                                                self.error("'%d/%d/%d': %s" % (tz, tx, ty, e.message))
 
-                                                        self.image_output.write_overview_tile(tx, ty, tz)
-                                                except Exception, e:
-                                                        self.error("'%d/%d/%d': %s" % (tz, tx, ty, e.message))
+                                        self.report_progress( ti / float(tcount) )
 
-                                        if not self.options.verbose:
-                                                self.progressbar( ti / float(tcount) )
+                return ti
 
         # -------------------------------------------------------------------------
-        def geo_query(self, ds, ulx, uly, lrx, lry, querysize = 0):
-                """For given dataset and query in cartographic coordinates
-                returns parameters for ReadRaster() in raster coordinates and
-                x/y shifts (for border tiles). If the querysize is not given, the
-                extent is returned in the native resolution of dataset ds."""
+        def generate_tiles_depth_first(self):
+                """Generation of the whole pyramid in one depth-first pass: the four children
+                of a tile are generated right before the tile itself, so that they are taken
+                from the tile cache instead of being read back from disk. At any time only the
+                children of one parent per level are pending in memory."""
 
-                geotran = ds.GetGeoTransform()
-                rx= int((ulx - geotran[0]) / geotran[1] + 0.001)
-                ry= int((uly - geotran[3]) / geotran[5] + 0.001)
-                rxsize= int((lrx - ulx) / geotran[1] + 0.5)
-                rysize= int((lry - uly) / geotran[5] + 0.5)
+                print "Generating Tiles (depth-first):"
 
-                if not querysize:
-                        wxsize, wysize = rxsize, rysize
+                tcount = 0
+                for tz in range(self.tmaxz, self.tminz-1, -1):
+                        tminx, tminy, tmaxx, tmaxy = self.tminmax[tz]
+                        tcount += (1+abs(tmaxx-tminx)) * (1+abs(tmaxy-tminy))
+
+                if self.options.processes > 1 and self.tmaxz > self.tminz:
+                        # Every worker generates the whole quadtree (base tiles included) below one
+                        # tile of the split level, only the tiles above it are generated after the join
+                        splitz = self.get_split_zoom()
+                        tminx, tminy, tmaxx, tmaxy = self.tminmax[splitz]
+                        roots = [(tx, ty, splitz) for ty in range(tmaxy, tminy-1, -1) for tx in range(tminx, tmaxx+1)]
+                        ti = self.run_parallel(depth_first_worker, roots, tcount)
+                        ti = self.generate_overview_levels(splitz-1, ti, tcount)
                 else:
-                        wxsize, wysize = querysize, querysize
+                        ti = 0
+                        tminx, tminy, tmaxx, tmaxy = self.tminmax[self.tminz]
+                        for ty in range(tmaxy, tminy-1, -1):
+                                for tx in range(tminx, tmaxx+1):
+                                        try:
+                                                for count in self.iter_depth_first(tx, ty, self.tminz):
+                                                        ti += count
+                                                        self.report_progress( ti / float(tcount) )
+                                        except ImageOutputException, e:
+                                                self.error(e.message)
+
+                # Every tile is accounted once, generated or skipped: a subtree missed would
+                # leave its base tiles out and the overviews above them empty
+                if not self.stopped and ti != tcount:
+                        self.error("%d tiles were generated or skipped instead of %d." % (ti, tcount))
+
+        # -------------------------------------------------------------------------
+        def iter_depth_first(self, tx, ty, tz):
+                """Generation of the quadtree with the given root, children first. Yields the
+                number of tiles processed as it goes."""
+
+                if self.stopped:
+                        return
+
+                # The base tiles are generated in metatile blocks below the level basez, a
+                # subtree skipped below it leaves its base tiles to the count of the block
+                basez = self.get_base_block_zoom()
+                if tz > basez:
+                        countz = self.tmaxz - 1
+                else:
+                        countz = self.tmaxz
+
+                if self.options.resume and self.image_output.tile_exists(tx, ty, tz):
+                        # A tile is generated only after all of its children, the subtree is complete
+                        if self.options.verbose:
+                                print "Tile generation skiped because of --resume"
+                        yield self.count_subtree(tx, ty, tz, countz)
+                        return
+
+                # Nothing to generate under an empty tile
+                if self.is_empty_tile(tx, ty, tz):
+                        yield self.count_subtree(tx, ty, tz, countz)
+                        return
+
+                if tz == basez:
+                        shift = self.tmaxz - tz
+                        yield self.generate_base_block(tx << shift, ty << shift, 1 << shift, self.tmaxz)
+                if tz == self.tmaxz:
+                        return
+
+                tminx, tminy, tmaxx, tmaxy = self.tminmax[tz+1]
+                for y in range(2*ty+1, 2*ty-1, -1):
+                        for x in range(2*tx, 2*tx+2):
+                                if tminx <= x <= tmaxx and tminy <= y <= tmaxy:
+                                        for count in self.iter_depth_first(x, y, tz+1):
+                                                yield count
+
+                if self.stopped:
+                        return
+
+                try:
+                        self.generate_overview_tile(tx, ty, tz)
+                except Exception, e:
+                        raise ImageOutputException("'%d/%d/%d': %s" % (tz, tx, ty, e.message))
+                yield 1
+
+        # -------------------------------------------------------------------------
+        def count_subtree(self, tx, ty, tz, maxz=None):
+                """Number of tiles in the quadtree with the given root, down to the base tiles
+                or to the level maxz"""
+
+                if maxz is None:
+                        maxz = self.tmaxz
+                count = 0
+                for z in range(tz, maxz+1):
+                        shift = z - tz
+                        tminx, tminy, tmaxx, tmaxy = self.tminmax[z]
+                        sminx, smaxx = max(tminx, tx << shift), min(tmaxx, ((tx+1) << shift) - 1)
+                        sminy, smaxy = max(tminy, ty << shift), min(tmaxy, ((ty+1) << shift) - 1)
+                        count += max(0, smaxx-sminx+1) * max(0, smaxy-sminy+1)
+                return count
+
+        # -------------------------------------------------------------------------
+        def get_base_block_zoom(self):
+                """Zoom level of the tiles whose quadtree holds one metatile block of base tiles"""
+
+                return max(self.tminz, self.tmaxz - self.metatile_shift)
+
+        # -------------------------------------------------------------------------
+        def get_split_zoom(self):
+                """Zoom level at which the overview pyramid is split into subtrees for the
+                worker processes: the user supplied one, or the first level with enough
+                tiles to keep all the workers busy. In the depth-first mode it is not below
+                the level of the metatile blocks, every subtree must hold whole blocks."""
+
+                if self.options.split_zoom is not None:
+                        splitz = max(self.tminz, min(self.options.split_zoom, self.tmaxz-1))
+                else:
+                        splitz = self.tmaxz-1
+                        for tz in range(self.tminz, self.tmaxz):
+                                tminx, tminy, tmaxx, tmaxy = self.tminmax[tz]
+                                if (1+abs(tmaxx-tminx)) * (1+abs(tmaxy-tminy)) >= 4 * self.options.processes:
+                                        splitz = tz
+                                        break
+
+                if self.options.depth_first:
+                        splitz = min(splitz, self.get_base_block_zoom())
+                return splitz
+
+        # -------------------------------------------------------------------------
+        def generate_overview_subtree(self, tx, ty, tz):
+                """Generation of all the overview tiles in the quadtree with the given root,
+                from the level above the base tiles up to the root itself. Returns the number
+                of tiles processed."""
+
+                count = 0
+                for z in range(self.tmaxz-1, tz-1, -1):
+                        shift = z - tz
+                        tminx, tminy, tmaxx, tmaxy = self.tminmax[z]
+                        # Tiles of level z below the root, cropped to the extent of the raster
+                        sminx, smaxx = max(tminx, tx << shift), min(tmaxx, ((tx+1) << shift) - 1)
+                        sminy, smaxy = max(tminy, ty << shift), min(tmaxy, ((ty+1) << shift) - 1)
+                        for y in range(smaxy, sminy-1, -1):
+                                for x in range(sminx, smaxx+1):
+                                        if self.stopped:
+                                                return count
+                                        try:
+                                                self.generate_overview_tile(x, y, z)
+                                        except Exception, e:
+                                                raise ImageOutputException("'%d/%d/%d': %s" % (z, x, y, e.message))
+                                        count += 1
+                return count
+
+        # -------------------------------------------------------------------------
+        def generate_overview_tile(self, tx, ty, tz):
+                """Generation of one overview tile from the four underlying tiles"""
+
+                if self.is_empty_tile(tx, ty, tz):
+                        return
+
+                if self.options.resume and self.image_output.tile_exists(tx, ty, tz):
+                        if self.options.verbose:
+                                print "Tile generation skiped because of --resume"
+                        return
+
+                if self.copy_previous_tile(tx, ty, tz):
+                        return
+
+                if self.options.verbose:
+                        print "\tbuild from zoom", tz+1," tiles:", (2*tx, 2*ty), (2*tx+1, 2*ty),(2*tx, 2*ty+1), (2*tx+1, 2*ty+1)
+
+                self.image_output.write_overview_tile(tx, ty, tz)
+
+        # -------------------------------------------------------------------------
+        def geo_query(self, ds, ulx, uly, lrx, lry, querysize = 0):
+                """For given dataset and query in cartographic coordinates
+                returns parameters for ReadRaster() in raster coordinates and
+                x/y shifts (for border tiles). If the querysize is not given, the
+                extent is returned in the native resolution of dataset ds."""
+
+                geotran = ds.GetGeoTransform()
+                rx= int((ulx - geotran[0]) / geotran[1] + 0.001)
+                ry= int((uly - geotran[3]) / geotran[5] + 0.001)
+                rxsize= int((lrx - ulx) / geotran[1] + 0.5)
+                rysize= int((lry - uly) / geotran[5] + 0.5)
+
+                if not querysize:
+                        wxsize, wysize = rxsize, rysize
+                else:
+                        wxsize, wysize = querysize, querysize
 
                 # Coordinates should not go out of the bounds of the raster
                 wx = 0
@@ -1278,7 +2487,7 @@ gdal2tiles temp.vrt""" % self.input )
                 args['title'] = self.options.title
                 args['south'], args['west'], args['north'], args['east'] = self.swne
                 args['tilesize'] = self.tilesize
-                args['tileformat'] = format_extension[self.image_output.format]
+                args['tileformat'] = self.image_output.extensions[self.image_output.format]
                 args['mime'] = format_mime[self.image_output.format]
                 args['publishurl'] = self.options.url
                 args['profile'] = self.options.profile
@@ -1322,21 +2531,39 @@ gdal2tiles temp.vrt""" % self.input )
 # =============================================================================
 
 
-def ImageOutput(name, out_ds, tile_size, resampling, nodata, output_dir):
+def ImageOutput(name, out_ds, tile_size, resampling, nodata, store, tile_cache_size=0,
+                jpeg_quality=None, creation_options=None, extension=None, write_threads=0):
 
         """Return object representing tile image output implementing given parameters."""
 
         resampler = Resampler(resampling)
 
+        # Encoder options of the tile drivers
+        write_options = {}
+        for image_format in format_extension:
+                write_options[image_format] = list(creation_options or [])
+        if jpeg_quality is not None:
+                write_options["JPEG"].append("QUALITY=%d" % jpeg_quality)
+
         if name == "hybrid":
-                return HybridImageOutput(out_ds, tile_size, resampler, nodata, output_dir)
+                output = HybridImageOutput(out_ds, tile_size, resampler, nodata, store, tile_cache_size, write_options,
+                                           write_threads)
+                output.composite = (resampling == "antialias")
+                return output
 
         if name == "png":
                 image_format = "PNG"
         elif name == "jpeg":
                 image_format = "JPEG"
 
-        return SimpleImageOutput(out_ds, tile_size, resampler, nodata, output_dir, [image_format])
+        extensions = dict(format_extension)
+        if extension:
+                extensions[image_format] = extension
+
+        output = SimpleImageOutput(out_ds, tile_size, resampler, nodata, store, [image_format], tile_cache_size,
+                                   write_options, extensions, write_threads)
+        output.composite = (resampling == "antialias")
+        return output
 
 
 class ImageOutputException(Exception):
@@ -1348,27 +2575,73 @@ class BaseImageOutput(object):
 
         """Base class for image output.
         
-        Child classes are supposed to provide two methods `write_base_tile' and
-        `write_overview_tile'. These will call `create_base_tile' and `create_overview_tile'
-        with arguments appropriate to their output strategy.
+        Child classes are supposed to provide the methods `write_base_tile',
+        `write_base_pixels' and `write_overview_tile'. These will call `create_base_tile',
+        `create_tile_from_pixels' and `create_overview_tile' with arguments appropriate
+        to their output strategy.
 
         When this class is instantiated with only one image format, it is stored in
-        a member field `format'.
+        a member field `format'. The tiles of every format are written into the tile
+        store with the file extension and the driver options given for it in
+        `extensions' and `write_options'.
+
+        All the tiles are written by `write_tile', which also keeps their pixels in
+        the tile cache (if enabled) for `create_overview_tile'.
+
+        With write threads the tiles are encoded and written by a `TileWriter' while
+        the next ones are read and resampled. The tiles queued there count as
+        existing already, a parent needing one of them from the store waits for it.
+
+        Tiles of one solid colour are encoded only once per image format and colour,
+        their duplicates are linked to the first one in the tile store. A solid
+        tile is recognized from the source pixels already, before resampling, and
+        an overview tile from its four children of the same colour.
         """
 
-        def __init__(self, out_ds, tile_size, resampler, nodata, output_dir, image_formats):
+        def __init__(self, out_ds, tile_size, resampler, nodata, store, image_formats, tile_cache_size=0,
+                     write_options=None, extensions=None, write_threads=0):
                 self.out_ds = out_ds
                 self.tile_size = tile_size
                 self.resampler = resampler
                 self.nodata = nodata
-                self.output_dir = output_dir
+                self.store = store
                 self.image_formats = image_formats
                 if len(self.image_formats) == 1:
                         self.format = self.image_formats[0]
+                self.write_options = write_options or {}
+                self.extensions = extensions or format_extension
 
                 self.mem_drv = get_gdal_driver("MEM")
                 self.alpha_filler = None
 
+                # Tiles with transparency composited over those of an earlier run ('antialias')
+                self.composite = False
+
+                # Pixels of a --mosaic composed query by query, instead of read from out_ds
+                self.mosaic = None
+
+                # Scratch MEM datasets reused from tile to tile, by (role, size, bands)
+                self.mem_pool = {}
+
+                # Store reference of the first tile of each solid colour, by (image format, colour)
+                self.solid_tiles = {}
+
+                if tile_cache_size > 0:
+                        self.tile_cache = TileCache(tile_cache_size)
+                else:
+                        self.tile_cache = None
+                # Tiles of this zoom level and above are not cached, their parents are not
+                # built by this process (set by the tiler for the minimal zoom level and the
+                # tasks of the worker processes)
+                self.cache_minz = 0
+
+                # Every access to the store goes under the lock, the writer threads share it
+                self.store_lock = threading.Lock()
+                if write_threads > 0:
+                        self.writer = TileWriter(store, self.store_lock, write_threads)
+                else:
+                        self.writer = None
+
                 # For raster with 4-bands: 4th unknown band set to alpha
                 if self.out_ds.RasterCount == 4 and self.out_ds.GetRasterBand(4).GetRasterColorInterpretation() == gdal.GCI_Undefined:
                         self.out_ds.GetRasterBand(4).SetRasterColorInterpretation(gdal.GCI_AlphaBand)
@@ -1392,39 +2665,102 @@ class BaseImageOutput(object):
 
                 data_bands = range(1, self.data_bands_count+1)
 
-                dstile = self.mem_drv.Create('', self.tile_size, self.tile_size, num_bands)
-                data = self.out_ds.ReadRaster(xyzzy.rx, xyzzy.ry, xyzzy.rxsize, xyzzy.rysize,
-                                                                          xyzzy.wxsize, xyzzy.wysize, band_list=data_bands)
+                data = self.read_data(xyzzy, data_bands)
+
+                # Source covering the whole tile in one colour gives the same colour whatever the resampling
+                full = xyzzy.covers_query()
+                if full:
+                        pixels = xyzzy.wxsize * xyzzy.wysize
+                        color = solid_color(data, self.data_bands_count, pixels)
+                        if color is not None and alpha is not None:
+                                alpha_color = solid_color(alpha, 1, pixels)
+                                color = alpha_color and color + alpha_color
+                        if color is not None:
+                                self.write_tile(tx, ty, tz, None, image_format, color)
+                                return
 
-                path = self.get_full_path(tx, ty, tz, format_extension[image_format])
+                dstile = self.get_tile_dataset(num_bands)
 
                 # Query is in 'nearest neighbour' but can be bigger in then the tilesize
                 # We scale down the query to the tilesize by supplied algorithm.
                 if self.tile_size == xyzzy.querysize:
                         # Use the ReadRaster result directly in tiles ('nearest neighbour' query)
+                        if not full:
+                                self.reset_mem_dataset(dstile)
                         dstile.WriteRaster(xyzzy.wx, xyzzy.wy, xyzzy.wxsize, xyzzy.wysize, data, band_list=data_bands)
                         if alpha is not None:
                                 dstile.WriteRaster(xyzzy.wx, xyzzy.wy, xyzzy.wxsize, xyzzy.wysize, alpha, band_list=[num_bands])
 
-                        gdal_write(path, dstile, image_format)
-
                         # Note: For source drivers based on WaveLet compression (JPEG2000, ECW, MrSID)
                         # the ReadRaster function returns high-quality raster (not ugly nearest neighbour)
                         # TODO: Use directly 'near' for WaveLet files
                 else:
                         # Big ReadRaster query in memory scaled to the tilesize - all but 'near' algo
-                        dsquery = self.mem_drv.Create('', xyzzy.querysize, xyzzy.querysize, num_bands)
+                        dsquery = self.get_mem_dataset('query', xyzzy.querysize, num_bands)
 
                         # TODO: fill the null value in case a tile without alpha is produced (now only png tiles are supported)
-                        if alpha is None:
-                                for i,v in enumerate(self.nodata[:num_bands]):
-                                        dsquery.GetRasterBand(i+1).Fill(v)
+                        if not full:
+                                self.reset_mem_dataset(dsquery, alpha is None and self.nodata)
 
                         dsquery.WriteRaster(xyzzy.wx, xyzzy.wy, xyzzy.wxsize, xyzzy.wysize, data, band_list=data_bands)
                         if alpha is not None:
                                 dsquery.WriteRaster(xyzzy.wx, xyzzy.wy, xyzzy.wxsize, xyzzy.wysize, alpha, band_list=[num_bands])
 
-                        self.resampler(path, dsquery, dstile, image_format)
+                        self.resampler(dsquery, dstile)
+
+                self.write_tile(tx, ty, tz, dstile, image_format)
+
+        def write_base_block(self, bx, by, size, tz, tiles, xyzzy):
+
+                """Create the given base tiles of the block of size x size tiles with the lower
+                left tile bx, by, from one query of the whole block resampled at once. Every
+                tile cut out of it is passed to `write_base_pixels'."""
+
+                with_alpha = "PNG" in self.image_formats
+                num_bands = self.data_bands_count + int(with_alpha)
+                data_bands = range(1, self.data_bands_count+1)
+                blocksize = size * self.tile_size
+
+                data = self.read_data(xyzzy, data_bands)
+
+                # Not pooled, the block datasets are let go with the block: one Create per
+                # block is little, and they would hold the memory of the largest block for good
+                dsblock = self.mem_drv.Create('', blocksize, blocksize, num_bands)
+                if xyzzy.querysize == blocksize:
+                        dsquery = dsblock
+                else:
+                        dsquery = self.mem_drv.Create('', xyzzy.querysize, xyzzy.querysize, num_bands)
+
+                if not with_alpha and not xyzzy.covers_query():
+                        self.reset_mem_dataset(dsquery, self.nodata)
+
+                dsquery.WriteRaster(xyzzy.wx, xyzzy.wy, xyzzy.wxsize, xyzzy.wysize, data, band_list=data_bands)
+                if with_alpha:
+                        dsquery.WriteRaster(xyzzy.wx, xyzzy.wy, xyzzy.wxsize, xyzzy.wysize, self.read_alpha(xyzzy), band_list=[num_bands])
+
+                if dsquery is not dsblock:
+                        self.resampler(dsquery, dsblock)
+
+                for tx, ty in tiles:
+                        ox, oy = (tx - bx) * self.tile_size, (by + size - 1 - ty) * self.tile_size
+                        data = dsblock.ReadRaster(ox, oy, self.tile_size, self.tile_size, band_list=data_bands)
+                        if with_alpha:
+                                alpha = dsblock.GetRasterBand(num_bands).ReadRaster(ox, oy, self.tile_size, self.tile_size)
+                        else:
+                                alpha = None
+                        self.write_base_pixels(tx, ty, tz, data, alpha)
+
+        def create_tile_from_pixels(self, tx, ty, tz, data, alpha, image_format):
+
+                """Create image of a tile from its resampled pixels and write it to disk."""
+
+                num_bands = self.data_bands_count + int(alpha is not None)
+                dstile = self.get_tile_dataset(num_bands)
+                dstile.WriteRaster(0, 0, self.tile_size, self.tile_size, data, band_list=range(1, self.data_bands_count+1))
+                if alpha is not None:
+                        dstile.WriteRaster(0, 0, self.tile_size, self.tile_size, alpha, band_list=[num_bands])
+
+                self.write_tile(tx, ty, tz, dstile, image_format)
 
         def create_overview_tile(self, tx, ty, tz, image_format):
 
@@ -1435,15 +2771,30 @@ class BaseImageOutput(object):
                 else:
                         num_bands = self.data_bands_count
 
-                dsquery = self.mem_drv.Create('', 2*self.tile_size, 2*self.tile_size, num_bands)
+                t = STATS.start()
+                children = [(cx, cy) + self.read_tile(cx, cy, tz+1, child_image_format)
+                            for cx, cy, child_image_format in self.iter_children(tx, ty, tz)]
+                STATS.stop('read_children', t, sum(len(child[3]) for child in children))
+
+                # Four children of the same solid colour make the parent of that colour
+                if len(children) == 4:
+                        colors = set()
+                        for cx, cy, child_bands, child_data in children:
+                                color = solid_color(child_data, child_bands, self.tile_size * self.tile_size)
+                                if color is None:
+                                        break
+                                colors.add((color + '\xff')[:num_bands])
+                        else:
+                                if len(colors) == 1:
+                                        self.write_tile(tx, ty, tz, None, image_format, colors.pop())
+                                        return
 
-                if image_format == "PNG":
-                        dsquery.GetRasterBand(num_bands).Fill(0)
-                else:
-                        for i,v in enumerate(self.nodata[:num_bands]):
-                                dsquery.GetRasterBand(i+1).Fill(v)
+                # Four children cover the whole query, with the alpha band too
+                dsquery = self.get_mem_dataset('overview', 2*self.tile_size, num_bands)
+                if len(children) < 4:
+                        self.reset_mem_dataset(dsquery, image_format != "PNG" and self.nodata)
 
-                for cx, cy, child_image_format in self.iter_children(tx, ty, tz):
+                for cx, cy, child_bands, child_data in children:
                         if (ty==0 and cy==1) or (ty!=0 and (cy % (2*ty)) != 0):
                                 tileposy = 0
                         else:
@@ -1455,20 +2806,179 @@ class BaseImageOutput(object):
                         else:
                                 tileposx = 0
 
-                        path = self.get_full_path(cx, cy, tz+1, format_extension[child_image_format])
-                        dsquerytile = gdal.Open(path, gdal.GA_ReadOnly)
+                        # Opaque PNG children of a JPEG parent lose their alpha band
+                        if child_bands > num_bands:
+                                child_bands = num_bands
+                                child_data = child_data[:num_bands * self.tile_size * self.tile_size]
 
                         dsquery.WriteRaster(tileposx, tileposy, self.tile_size, self.tile_size,
-                                dsquerytile.ReadRaster(0, 0, self.tile_size, self.tile_size),
-                                band_list=range(1, dsquerytile.RasterCount+1))
+                                child_data, band_list=range(1, child_bands+1))
 
-                        if image_format == "PNG" and dsquerytile.RasterCount != num_bands:
+                        if image_format == "PNG" and child_bands != num_bands:
                                 dsquery.WriteRaster(tileposx, tileposy, self.tile_size, self.tile_size,
                                         self.get_alpha_filler(), band_list=[num_bands])
 
-                dstile = self.mem_drv.Create('', self.tile_size, self.tile_size, num_bands)
-                path = self.get_full_path(tx, ty, tz, format_extension[image_format])
-                self.resampler(path, dsquery, dstile, image_format)
+                dstile = self.get_tile_dataset(num_bands)
+                self.resampler(dsquery, dstile)
+
+                self.write_tile(tx, ty, tz, dstile, image_format)
+
+        def write_tile(self, tx, ty, tz, dstile, image_format, color=None):
+
+                """Write the finished tile to the store and keep its pixels for the parent tile.
+
+                A tile known to be of one solid colour is given by the colour (one byte
+                per band) instead of `dstile'."""
+
+                pixels = self.tile_size * self.tile_size
+                extension = self.extensions[image_format]
+
+                if dstile is None and self.composite and len(color) in (2, 4) and color[-1] != '\xff':
+                        # Not opaque, composited over the tile of an earlier run as the others
+                        dstile = self.get_solid_dataset(color)
+
+                if dstile is not None and self.composite:
+                        self.composite_over_existing(tx, ty, tz, dstile, extension)
+
+                if dstile is not None:
+                        data = dstile.ReadRaster(0, 0, self.tile_size, self.tile_size)
+                        color = solid_color(data, dstile.RasterCount, pixels)
+                else:
+                        data = None
+
+                key = (image_format, color)
+                if color is not None and key in self.solid_tiles:
+                        t = STATS.start()
+                        with self.store_lock:
+                                self.solid_tiles[key] = self.store.link_tile(tx, ty, tz, extension, self.solid_tiles[key])
+                        STATS.stop('link', t)
+                elif color is None and self.writer is not None:
+                        self.writer.put(tx, ty, tz, extension, dstile, image_format, self.write_options.get(image_format))
+                else:
+                        # The solid tiles are written right away, their reference is needed for the duplicates
+                        if dstile is None:
+                                dstile = self.get_solid_dataset(color)
+                        ref = store_tile(self.store, self.store_lock, tx, ty, tz, extension, dstile, image_format,
+                                         self.write_options.get(image_format))
+                        if color is not None:
+                                self.solid_tiles[key] = ref
+
+                if self.tile_cache is not None and tz > self.cache_minz:
+                        if data is None:
+                                data = "".join(c * pixels for c in color)
+                        self.tile_cache.put((tx, ty, tz), len(data) / pixels, data)
+
+        def get_solid_dataset(self, color):
+
+                """Return the scratch dataset of a tile filled with the colour."""
+
+                dstile = self.get_mem_dataset('solid', self.tile_size, len(color))
+                for i, c in enumerate(color):
+                        dstile.GetRasterBand(i+1).Fill(ord(c))
+                return dstile
+
+        def get_mem_dataset(self, role, size, bands):
+
+                """Return the MEM dataset of size x size pixels and bands kept for the role, one
+                per role for the scratch datasets used within one call. It holds the pixels
+                left by its previous use, see `reset_mem_dataset'. Only for the datasets of
+                one tile and its query, those of the metatile blocks are not kept."""
+
+                key = (role, size, bands)
+                ds = self.mem_pool.get(key)
+                if ds is None:
+                        ds = self.mem_pool[key] = self.mem_drv.Create('', size, size, bands)
+                return ds
+
+        def get_tile_dataset(self, bands):
+
+                """Return a MEM dataset for a tile to be written. It is reused unless the tiles
+                are queued to the writer threads, which still hold the previous ones."""
+
+                if self.writer is not None:
+                        return self.mem_drv.Create('', self.tile_size, self.tile_size, bands)
+                return self.get_mem_dataset('tile', self.tile_size, bands)
+
+        def reset_mem_dataset(self, ds, values=None):
+
+                """Fill the bands of a dataset from the pool with the values given for them (the
+                NODATA), the rest with 0, as in a new dataset."""
+
+                for i in range(ds.RasterCount):
+                        if values and i < len(values):
+                                ds.GetRasterBand(i+1).Fill(values[i])
+                        else:
+                                ds.GetRasterBand(i+1).Fill(0)
+
+        def composite_over_existing(self, tx, ty, tz, dstile, extension):
+
+                """Composite the tile over the one left in the store by an earlier run, e.g. on
+                an overlapping chart, where the tile is not opaque. The tile of the earlier
+                run is not in memory, it is read and decoded from the store, only for the
+                tiles with transparency and only if the store has one. The tiles of this run
+                are written once, they are never composited over themselves."""
+
+                bands = dstile.RasterCount
+                if bands not in (2, 4):
+                        return
+                size = self.tile_size
+                alpha = dstile.GetRasterBand(bands).ReadRaster(0, 0, size, size)
+                if solid_color(alpha, 1, size * size) == '\xff':
+                        return
+                with self.store_lock:
+                        existing = self.store.read_existing_tile(tx, ty, tz, extension)
+                if existing is None or existing[0] != bands:
+                        return
+
+                mode = image_modes[bands]
+                new = pil_image(mode, size, dstile.ReadRaster(0, 0, size, size))
+                old = pil_image(mode, size, existing[1])
+                composite = Image.composite(new, old, new.split()[-1])
+                for i, band in enumerate(composite.split()):
+                        dstile.GetRasterBand(i+1).WriteRaster(0, 0, size, size, band.tobytes())
+
+        def read_tile(self, tx, ty, tz, image_format):
+
+                """Return the number of bands and the pixels of a tile produced before,
+                from the tile cache or decoded from the store."""
+
+                t = STATS.start()
+                if self.tile_cache is not None:
+                        cached = self.tile_cache.take((tx, ty, tz))
+                        if cached is not None:
+                                STATS.stop('tile_cache_hit', t)
+                                return cached
+
+                extension = self.extensions[image_format]
+                if self.writer is not None and self.writer.is_pending(tx, ty, tz, extension):
+                        self.writer.flush()
+                with self.store_lock:
+                        tile = self.store.read_tile(tx, ty, tz, extension)
+                STATS.stop('tile_store_read', t)
+                return tile
+
+        def import_tile(self, source, tx, ty, tz):
+                """Copy the tile over from another tile store, in whatever format it is there.
+                Returns False if the source has no such tile."""
+                for image_format in self.image_formats:
+                        extension = self.extensions[image_format]
+                        if source.tile_exists(tx, ty, tz, extension):
+                                with self.store_lock:
+                                        self.store.import_tile(source, tx, ty, tz, extension)
+                                return True
+                return False
+
+        def flush(self):
+                """Wait for the tiles queued for writing and flush the store."""
+                if self.writer is not None:
+                        self.writer.flush()
+                with self.store_lock:
+                        self.store.flush()
+
+        def close(self):
+                self.flush()
+                if self.writer is not None:
+                        self.writer.close()
 
         def iter_children(self, tx, ty, tz):
                 """Generate all children of the given tile produced on the lower level."""
@@ -1478,8 +2988,24 @@ class BaseImageOutput(object):
                                 if image_format is not None:
                                         yield x, y, image_format
 
+        def read_data(self, xyzzy, data_bands):
+                t = STATS.start()
+                if self.mosaic is not None:
+                        data = self.mosaic.read(xyzzy, data_bands)
+                else:
+                        data = self.out_ds.ReadRaster(xyzzy.rx, xyzzy.ry, xyzzy.rxsize, xyzzy.rysize,
+                                                      xyzzy.wxsize, xyzzy.wysize, band_list=data_bands)
+                STATS.stop('read', t, len(data))
+                return data
+
         def read_alpha(self, xyzzy):
-                return self.alpha_band.ReadRaster(xyzzy.rx, xyzzy.ry, xyzzy.rxsize, xyzzy.rysize, xyzzy.wxsize, xyzzy.wysize)
+                t = STATS.start()
+                if self.mosaic is not None:
+                        alpha = self.mosaic.read_alpha(xyzzy)
+                else:
+                        alpha = self.alpha_band.ReadRaster(xyzzy.rx, xyzzy.ry, xyzzy.rxsize, xyzzy.rysize, xyzzy.wxsize, xyzzy.wysize)
+                STATS.stop('read_alpha', t, len(alpha))
+                return alpha
 
         def get_alpha_filler(self):
                 if self.alpha_filler is None:
@@ -1487,17 +3013,21 @@ class BaseImageOutput(object):
                 return self.alpha_filler
 
         def try_to_use_existing_tile(self, tx, ty, tz):
-                """Return image format of the tile if it exists already on disk."""
+                """Return image format of the tile if it exists already in the store (or is queued for it)."""
                 for image_format in self.image_formats:
-                        if os.path.exists(self.get_full_path(tx, ty, tz, format_extension[image_format])):
+                        extension = self.extensions[image_format]
+                        if self.writer is not None and self.writer.is_pending(tx, ty, tz, extension):
                                 return image_format
+                        with self.store_lock:
+                                if self.store.tile_exists(tx, ty, tz, extension):
+                                        return image_format
                 return None
 
         def tile_exists(self, tx, ty, tz):
                 return self.try_to_use_existing_tile(tx, ty, tz) != None
 
         def get_full_path(self, tx, ty, tz, extension):
-                return os.path.join(self.output_dir, get_tile_filename(tx, ty, tz, extension))
+                return self.store.get_full_path(tx, ty, tz, extension)
 
 
 class SimpleImageOutput(BaseImageOutput):
@@ -1512,6 +3042,9 @@ class SimpleImageOutput(BaseImageOutput):
 
                 self.create_base_tile(tx, ty, tz, xyzzy, alpha, self.format)
 
+        def write_base_pixels(self, tx, ty, tz, data, alpha):
+                self.create_tile_from_pixels(tx, ty, tz, data, alpha, self.format)
+
         def write_overview_tile(self, tx, ty, tz):
                 self.create_overview_tile(tx, ty, tz, self.format)
 
@@ -1525,22 +3058,32 @@ class HybridImageOutput(BaseImageOutput):
         tiles. Otherwise the resume feature wouldn't work.
         """
 
-        def __init__(self, out_ds, tile_size, resampler, nodata, output_dir):
-                BaseImageOutput.__init__(self, out_ds, tile_size, resampler, nodata, output_dir, ["JPEG", "PNG"])
+        def __init__(self, out_ds, tile_size, resampler, nodata, store, tile_cache_size=0, write_options=None,
+                     write_threads=0):
+                BaseImageOutput.__init__(self, out_ds, tile_size, resampler, nodata, store, ["JPEG", "PNG"], tile_cache_size,
+                                         write_options, None, write_threads)
 
         def write_base_tile(self, tx, ty, tz, xyzzy):
-                alpha = self.read_alpha(xyzzy)
-                transparent, opaque = self.transparent_or_opaque(alpha)
+                image_format, alpha = self.base_tile_format(self.read_alpha(xyzzy))
+                if image_format is not None:
+                        self.create_base_tile(tx, ty, tz, xyzzy, alpha, image_format)
+
+        def write_base_pixels(self, tx, ty, tz, data, alpha):
+                image_format, alpha = self.base_tile_format(alpha)
+                if image_format is not None:
+                        self.create_tile_from_pixels(tx, ty, tz, data, alpha, image_format)
+
+        def base_tile_format(self, alpha):
+                """Return the image format of a base tile with the given alpha and the alpha
+                to write with it. No format for a fully transparent tile."""
+                transparent, opaque = transparent_or_opaque(alpha)
 
                 if transparent:
-                        return
+                        return None, None
                 elif opaque:
-                        image_format = "JPEG"
-                        alpha = None
+                        return "JPEG", None
                 else:
-                        image_format = "PNG"
-
-                self.create_base_tile(tx, ty, tz, xyzzy, alpha, image_format)
+                        return "PNG", alpha
 
         def write_overview_tile(self, tx, ty, tz):
                 children = list(self.iter_children(tx, ty, tz))
@@ -1548,56 +3091,175 @@ class HybridImageOutput(BaseImageOutput):
                 if len(children) == 0:
                         return
 
-                if any(image_format == "PNG" for x, y, image_format in children) or len(children) < 4:
+                if len(children) < 4:
                         image_format = "PNG"
-                else:
+                elif all(image_format == "JPEG" for x, y, image_format in children):
                         image_format = "JPEG"
+                else:
+                        # Classify the parent from the alpha of its PNG children, if they are in memory
+                        alphas = [self.get_cached_alpha(x, y, tz+1) for x, y, image_format in children if image_format == "PNG"]
+                        if None not in alphas and transparent_or_opaque(*alphas)[1]:
+                                image_format = "JPEG"
+                        else:
+                                image_format = "PNG"
 
                 self.create_overview_tile(tx, ty, tz, image_format)
 
-        def transparent_or_opaque(self, alpha):
-                transparent = opaque = True
-                for c in alpha:
-                        transparent = transparent and c == '\x00'
-                        opaque = opaque and c == '\xff'
-                assert not (transparent and opaque)
-                return transparent, opaque
+        def get_cached_alpha(self, tx, ty, tz):
+                """Return the alpha band of a tile from the tile cache, None if not cached."""
+                if self.tile_cache is None:
+                        return None
+                cached = self.tile_cache.peek((tx, ty, tz))
+                if cached is None or cached[0] != self.data_bands_count + 1:
+                        return None
+                return cached[1][-self.tile_size * self.tile_size:]
+
+
+# PIL image modes of the tiles by their number of bands
+image_modes = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}
+
+
+def pil_image(mode, size, data):
+        """PIL image of the square tile of the given band sequential pixels (GDAL ReadRaster)"""
+        pixels = size * size
+        return Image.merge(mode, [Image.frombuffer('L', (size, size), data[i*pixels:(i+1)*pixels], 'raw', 'L', 0, 1)
+                                  for i in range(len(mode))])
+
+
+def transparent_or_opaque(*alphas):
+
+        """Classify the given alpha buffer(s) as fully transparent and/or fully opaque.
+
+        Every buffer is checked by counting its bytes in one C-level pass, the first
+        byte decides which count is worth doing at all.
+        """
+
+        transparent = opaque = True
+        for alpha in alphas:
+                if transparent:
+                        transparent = alpha[:1] == '\x00' and alpha.count('\x00') == len(alpha)
+                if opaque:
+                        opaque = alpha[:1] == '\xff' and alpha.count('\xff') == len(alpha)
+                if not transparent and not opaque:
+                        break
+        assert not (transparent and opaque)
+        return transparent, opaque
+
+
+def solid_color(data, bands, pixels):
+
+        """Return the colour (one byte per band) of the band sequential pixels if
+        they are all of one colour, None otherwise."""
+
+        color = ""
+        for i in range(bands):
+                c = data[i*pixels]
+                if data.count(c, i*pixels, (i+1)*pixels) != pixels:
+                        return None
+                color += c
+        return color
 
 
 def Resampler(name):
 
+        """Return a function performing given resampling algorithm, timed for --stats."""
+
+        resample = ResamplerFunction(name)
+        if not STATS.enabled:
+                return resample
+
+        def resample_timed(dsquery, dstile):
+                t = STATS.start()
+                resample(dsquery, dstile)
+                STATS.stop('resample_' + name, t)
+
+        return resample_timed
+
+
+def ResamplerFunction(name):
+
         """Return a function performing given resampling algorithm."""
 
-        def resample_average(path, dsquery, dstile, image_format):
+        def resample_average(dsquery, dstile):
                 for i in range(1, dstile.RasterCount+1):
                         res = gdal.RegenerateOverview(dsquery.GetRasterBand(i), dstile.GetRasterBand(i), "average")
                         if res != 0:
                             raise ImageOutputException("RegenerateOverview() failed with error %d" % res)
 
-                gdal_write(path, dstile, image_format)
-
-        def resample_antialias(path, dsquery, dstile, image_format):
+        def resample_antialias(dsquery, dstile):
+                """Lanczos by PIL, of the bands as they are (L, LA, RGB or RGBA), all read at once
+                pixel interleaved."""
                 querysize = dsquery.RasterXSize
                 tilesize = dstile.RasterXSize
+                bands = dstile.RasterCount
+                mode = image_modes[bands]
 
-                array = numpy.zeros((querysize, querysize, 4), numpy.uint8)
-                for i in range(dstile.RasterCount):
-                        array[:,:,i] = gdalarray.BandReadAsArray(dsquery.GetRasterBand(i+1), 0, 0, querysize, querysize)
-                im = Image.fromarray(array, 'RGBA') # Always four bands
-                im1 = im.resize((tilesize,tilesize), Image.ANTIALIAS)
+                data = dsquery.ReadRaster(0, 0, querysize, querysize, band_list=range(1, bands+1),
+                                          buf_pixel_space=bands, buf_line_space=querysize*bands, buf_band_space=1)
+                im = Image.frombuffer(mode, (querysize, querysize), data, 'raw', mode, 0, 1)
+                im = im.resize((tilesize, tilesize), antialias_filter)
 
-                if os.path.exists(path):
-                        im0 = Image.open(path)
-                        im1 = Image.composite(im1, im0, im1)
+                dstile.WriteRaster(0, 0, tilesize, tilesize, im.tobytes(), band_list=range(1, bands+1),
+                                   buf_pixel_space=bands, buf_line_space=tilesize*bands, buf_band_space=1)
 
-                ensure_dir_exists(path)
-                im1.save(path, image_format)
 
+        # Buffers of resample_box, by the shape of the strip
+        box_buffers = {}
+        # Query pixels per strip of resample_box, the buffers stay small for any query
+        box_strip_pixels = 1 << 18
+
+        def resample_box(dsquery, dstile):
+                """Mean of the f x f query pixels of every tile pixel, all the bands at once. Same as
+                'average' within the rounding, but for the colour of the pixels of partial alpha,
+                weighted by the alpha here. The query is read and reduced in strips of rows, so
+                the metatile blocks take no more memory than the tiles."""
+                querysize = dsquery.RasterXSize
+                tilesize = dstile.RasterXSize
+                bands = dstile.RasterCount
+                f = querysize / tilesize
+                if f * tilesize != querysize or dsquery.RasterCount != bands:
+                        return resample_average(dsquery, dstile)
+
+                rows = max(1, min(tilesize, box_strip_pixels / (querysize * f)))
+                shape = (bands, rows, f, tilesize, f)
+                buffers = box_buffers.get(shape)
+                if buffers is None:
+                        buffers = box_buffers[shape] = (numpy.empty((bands-1,) + shape[1:], numpy.uint32),
+                                                        numpy.empty((bands, rows, tilesize), numpy.uint32),
+                                                        numpy.empty((rows, tilesize), numpy.uint32))
+                pixels = f * f
+
+                for row in range(0, tilesize, rows):
+                        n = min(rows, tilesize - row)
+                        # Views of the buffers for the last strip, shorter than the others
+                        weighted, sums, total = buffers[0][:, :n], buffers[1][:, :n], buffers[2][:n]
+
+                        data = numpy.frombuffer(dsquery.ReadRaster(0, row * f, querysize, n * f),
+                                                numpy.uint8).reshape((bands, n, f, tilesize, f))
+                        if bands in (2, 4):
+                                alpha = data[-1]
+                                numpy.multiply(data[:-1], alpha, out=weighted, dtype=numpy.uint32)
+                                weighted.sum(axis=(2, 4), dtype=numpy.uint32, out=sums[:-1])
+                                alpha.sum(axis=(1, 3), dtype=numpy.uint32, out=sums[-1])
+                                numpy.maximum(sums[-1], 1, out=total)
+                                sums[:-1] += total / 2
+                                sums[:-1] /= total
+                                sums[-1] += pixels / 2
+                                sums[-1] /= pixels
+                        else:
+                                data.sum(axis=(2, 4), dtype=numpy.uint32, out=sums)
+                                sums += pixels / 2
+                                sums /= pixels
+
+                        dstile.WriteRaster(0, row, tilesize, n, sums.astype(numpy.uint8).tostring())
 
         if name == "average":
                 return resample_average
         elif name == "antialias":
+                antialias_filter = getattr(Image, 'LANCZOS', None) or Image.ANTIALIAS
                 return resample_antialias
+        elif name == "box":
+                return resample_box
 
         resampling_methods = {
                 "near"        : gdal.GRA_NearestNeighbour,
@@ -1609,7 +3271,7 @@ def Resampler(name):
 
         resampling_method = resampling_methods[name]
 
-        def resample_gdal(path, dsquery, dstile, image_format):
+        def resample_gdal(dsquery, dstile):
                 querysize = dsquery.RasterXSize
                 tilesize = dstile.RasterXSize
 
@@ -1620,15 +3282,655 @@ def Resampler(name):
                 if res != 0:
                     raise ImageOutputException("ReprojectImage() failed with error %d" % res)
 
-                gdal_write(path, dstile, image_format)
-
         return resample_gdal
 
 
-def gdal_write(path, dstile, image_format):
+class TileWriter(object):
+
+        """Pool of threads encoding and writing the tiles handed over by `put'.
+
+        The tiles wait in a queue of twice as many entries as there are threads, `put'
+        blocks when it is full, so the resampled tiles never pile up in memory. The
+        encoding happens in GDAL with the GIL released, only storing the encoded tile
+        goes under the store lock. The first error is raised by the next `put' or
+        `flush'.
+        """
+
+        def __init__(self, store, store_lock, threads):
+                self.store = store
+                self.store_lock = store_lock
+                self.queue = Queue.Queue(2 * threads)
+                self.pending = set()
+                self.error = None
+                self.threads = []
+                for i in range(threads):
+                        thread = threading.Thread(target=self.run)
+                        thread.daemon = True
+                        thread.start()
+                        self.threads.append(thread)
+
+        def put(self, tx, ty, tz, extension, dstile, image_format, options=None):
+                self.check()
+                self.pending.add((tx, ty, tz, extension))
+                self.queue.put((tx, ty, tz, extension, dstile, image_format, options))
+
+        def is_pending(self, tx, ty, tz, extension):
+                return (tx, ty, tz, extension) in self.pending
+
+        def run(self):
+                while True:
+                        job = self.queue.get()
+                        if job is None:
+                                self.queue.task_done()
+                                return
+                        tx, ty, tz, extension, dstile, image_format, options = job
+                        try:
+                                if self.error is None:
+                                        store_tile(self.store, self.store_lock, tx, ty, tz, extension, dstile, image_format, options)
+                        except Exception, e:
+                                self.error = "'%d/%d/%d': %s" % (tz, tx, ty, e)
+                        self.pending.discard((tx, ty, tz, extension))
+                        self.queue.task_done()
+
+        def flush(self):
+                self.queue.join()
+                self.check()
+
+        def check(self):
+                if self.error is not None:
+                        error, self.error = self.error, None
+                        raise ImageOutputException(error)
+
+        def close(self):
+                for thread in self.threads:
+                        self.queue.put(None)
+                for thread in self.threads:
+                        thread.join()
+
+
+def TileStore(name, output, replace=False, index=None, read_only=False):
+
+        """Return object representing the tile store of given name writing into output.
+        With replace the existing content of the output is thrown away. The tiles
+        present in the output are looked up in the index (a TileIndex), if given.
+        A read_only store is only read from, the output is left untouched."""
+
+        if name == "zip":
+                return ZipTileStore(output, replace, read_only)
+        elif name == "mbtiles":
+                return MBTilesTileStore(output, replace, index, read_only)
+
+        return FileTileStore(output, replace, index)
+
+
+class FileTileStore(object):
+
+        """Tiles and metadata written as files into the output directory, the tiles
+        as `z/x/y.ext'. Duplicate tiles are hard links to the first one written,
+        copies where the filesystem can't link.
+
+        Every tile is written under a temporary name and renamed when complete, so a
+        killed run leaves no truncated tiles behind. The completed tiles are recorded
+        in the append-only journal `journal_name', which is removed at the end of a
+        finished run. With an index the existing tiles are loaded from the journal,
+        or without one found by one scan of the directories (no stat of every tile),
+        and the index is updated as the tiles are written.
+        """
+
+        journal_name = "gdal2tiles.journal"
+
+        def __init__(self, output_dir, replace=False, index=None):
+                self.output_dir = output_dir
+                ensure_dir_exists(os.path.join(self.output_dir, ''))
+                self.journal_path = os.path.join(self.output_dir, self.journal_name)
+                self.journal = None
+                if replace:
+                        self.journal = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_TRUNC, 0644)
+                self.index = index
+                if self.index is not None:
+                        self.scan()
+
+        def scan(self):
+                """Fill the index with the tiles of the journal or, if there is none, with the
+                tiles found in the z/x/y.ext directories."""
+                if os.path.exists(self.journal_path):
+                        f = open(self.journal_path, 'rb')
+                        for line in f:
+                                entry = line.split()
+                                if len(entry) == 4 and line.endswith('\n'):
+                                        tz, tx, ty, extension = entry
+                                        self.index.add(int(tx), int(ty), int(tz), extension)
+                        f.close()
+                        return
+
+                for zname in os.listdir(self.output_dir):
+                        zdir = os.path.join(self.output_dir, zname)
+                        if not zname.isdigit() or not os.path.isdir(zdir):
+                                continue
+                        tz = int(zname)
+                        for xname in os.listdir(zdir):
+                                if not xname.isdigit():
+                                        continue
+                                tx = int(xname)
+                                for name in os.listdir(os.path.join(zdir, xname)):
+                                        gy, dot, extension = name.partition('.')
+                                        if gy.isdigit() and extension and not extension.endswith('.tmp'):
+                                                # The files are named by the Google tile numbering
+                                                self.index.add(tx, (1 << tz) - 1 - int(gy), tz, extension)
+
+        def refresh(self):
+                if self.index is not None:
+                        self.index.clear()
+                        self.scan()
+
+        def get_full_path(self, tx, ty, tz, extension):
+                return os.path.join(self.output_dir, get_tile_filename(tx, ty, tz, extension))
+
+        def tile_exists(self, tx, ty, tz, extension):
+                if self.index is not None:
+                        return self.index.contains(tx, ty, tz, extension)
+                return os.path.exists(self.get_full_path(tx, ty, tz, extension))
+
+        def get_temp_path(self, tx, ty, tz, extension):
+                path = self.get_full_path(tx, ty, tz, extension)
+                ensure_dir_exists(path)
+                return "%s.%d.tmp" % (path, os.getpid())
+
+        def commit_tile(self, tx, ty, tz, extension, temp_path):
+                """Move the complete tile file in place and record it in the journal."""
+                # The rename replaces the file, never writes through a hard link to another tile
+                replace_file(temp_path, self.get_full_path(tx, ty, tz, extension))
+                if self.journal is None:
+                        self.journal = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+                # One write of one short line, appended whole also among the worker processes
+                os.write(self.journal, "%d %d %d %s\n" % (tz, tx, ty, extension))
+                if self.index is not None:
+                        self.index.add(tx, ty, tz, extension)
+
+        def write_tile(self, tx, ty, tz, extension, dstile, image_format, options=None):
+                return self.store_encoded_tile(tx, ty, tz, extension,
+                        self.encode_tile(tx, ty, tz, extension, dstile, image_format, options))
+
+        def encode_tile(self, tx, ty, tz, extension, dstile, image_format, options=None):
+                temp_path = self.get_temp_path(tx, ty, tz, extension)
+                gdal_write(temp_path, dstile, image_format, options)
+                return temp_path
+
+        def store_encoded_tile(self, tx, ty, tz, extension, encoded):
+                self.commit_tile(tx, ty, tz, extension, encoded)
+                return self.get_full_path(tx, ty, tz, extension)
+
+        def encoded_size(self, encoded):
+                return os.path.getsize(encoded)
+
+        def link_tile(self, tx, ty, tz, extension, ref):
+                temp_path = self.get_temp_path(tx, ty, tz, extension)
+                try:
+                        os.link(ref, temp_path)
+                except (AttributeError, OSError):
+                        # No hard links here (or too many of them), the copy becomes the reference
+                        shutil.copyfile(ref, temp_path)
+                        ref = self.get_full_path(tx, ty, tz, extension)
+                self.commit_tile(tx, ty, tz, extension, temp_path)
+                return ref
+
+        def import_tile(self, source, tx, ty, tz, extension):
+                if isinstance(source, FileTileStore):
+                        self.link_tile(tx, ty, tz, extension, source.get_full_path(tx, ty, tz, extension))
+                else:
+                        temp_path = self.get_temp_path(tx, ty, tz, extension)
+                        f = open(temp_path, 'wb')
+                        f.write(source.read_tile_data(tx, ty, tz, extension))
+                        f.close()
+                        self.commit_tile(tx, ty, tz, extension, temp_path)
+
+        def read_tile(self, tx, ty, tz, extension):
+                dstile = gdal.Open(self.get_full_path(tx, ty, tz, extension), gdal.GA_ReadOnly)
+                return dstile.RasterCount, dstile.ReadRaster(0, 0, dstile.RasterXSize, dstile.RasterYSize)
+
+        def read_existing_tile(self, tx, ty, tz, extension):
+                """Return the pixels of the tile of an earlier run if there is one (not in the
+                index when this run replaces the output), else None."""
+                if not os.path.exists(self.get_full_path(tx, ty, tz, extension)):
+                        return None
+                return self.read_tile(tx, ty, tz, extension)
+
+        def read_tile_data(self, tx, ty, tz, extension):
+                f = open(self.get_full_path(tx, ty, tz, extension), 'rb')
+                data = f.read()
+                f.close()
+                return data
+
+        def file_exists(self, name):
+                return os.path.exists(os.path.join(self.output_dir, name))
+
+        def write_file(self, name, data):
+                f = open(os.path.join(self.output_dir, name), 'wb')
+                f.write(data)
+                f.close()
+
+        def write_metadata(self, values):
+                pass
+
+        def flush(self):
+                pass
+
+        def close(self, complete=True):
+                """Close the store, the run being complete unless told otherwise (a worker
+                process done with its part of the run)."""
+                if self.journal is not None:
+                        os.close(self.journal)
+                        self.journal = None
+                        # All the tiles are in place, the journal is not needed any more
+                        if complete:
+                                os.unlink(self.journal_path)
+
+
+class ZipTileStore(object):
+
+        """Tiles and metadata streamed straight into a ZIP archive.
+
+        The members are stored, not compressed again, the tiles are compressed
+        images already. An existing archive is appended to, unless replaced.
+        ZIP has no links, duplicate tiles are stored again from the encoded image.
+        """
+
+        def __init__(self, path, replace=False, read_only=False):
+                self.path = path
+                if read_only:
+                        self.zip = zipfile.ZipFile(self.path, 'r', allowZip64=True)
+                        self.names = set(self.zip.namelist())
+                        return
+                ensure_dir_exists(os.path.abspath(self.path))
+                if os.path.exists(self.path) and not replace:
+                        # An archive without its central directory (interrupted run) would be
+                        # appended to as a new one after the orphaned members
+                        if not zipfile.is_zipfile(self.path):
+                                raise zipfile.BadZipfile("File is not a zip file")
+                        mode = 'a'
+                else:
+                        mode = 'w'
+                self.zip = zipfile.ZipFile(self.path, mode, zipfile.ZIP_STORED, allowZip64=True)
+                self.names = set(self.zip.namelist())
+
+        def get_full_path(self, tx, ty, tz, extension):
+                return get_tile_filename(tx, ty, tz, extension).replace(os.sep, '/')
+
+        def tile_exists(self, tx, ty, tz, extension):
+                return self.get_full_path(tx, ty, tz, extension) in self.names
+
+        def write_tile(self, tx, ty, tz, extension, dstile, image_format, options=None):
+                return self.store_encoded_tile(tx, ty, tz, extension,
+                        self.encode_tile(tx, ty, tz, extension, dstile, image_format, options))
+
+        def encode_tile(self, tx, ty, tz, extension, dstile, image_format, options=None):
+                return gdal_encode(dstile, image_format, options)
+
+        def store_encoded_tile(self, tx, ty, tz, extension, encoded):
+                self.write_file(self.get_full_path(tx, ty, tz, extension), encoded)
+                return encoded
+
+        def encoded_size(self, encoded):
+                return len(encoded)
+
+        def link_tile(self, tx, ty, tz, extension, ref):
+                self.write_file(self.get_full_path(tx, ty, tz, extension), ref)
+                return ref
+
+        def import_tile(self, source, tx, ty, tz, extension):
+                self.write_file(self.get_full_path(tx, ty, tz, extension), source.read_tile_data(tx, ty, tz, extension))
+
+        def read_tile(self, tx, ty, tz, extension):
+                return gdal_decode(self.read_tile_data(tx, ty, tz, extension))
+
+        def read_existing_tile(self, tx, ty, tz, extension):
+                if not self.tile_exists(tx, ty, tz, extension):
+                        return None
+                return self.read_tile(tx, ty, tz, extension)
+
+        def read_tile_data(self, tx, ty, tz, extension):
+                return self.zip.read(self.get_full_path(tx, ty, tz, extension))
+
+        def file_exists(self, name):
+                return name in self.names
+
+        def write_file(self, name, data):
+                info = zipfile.ZipInfo(name, time.localtime()[:6])
+                info.external_attr = 0644 << 16
+                self.zip.writestr(info, data)
+                self.names.add(name)
+
+        def write_metadata(self, values):
+                pass
+
+        def flush(self):
+                pass
+
+        def refresh(self):
+                pass
+
+        def close(self, complete=True):
+                self.zip.close()
+
+
+class MBTilesTileStore(object):
+
+        """Tiles written into one MBTiles (SQLite) file.
+
+        The tiles are inserted in batches of `batch_size', each in one transaction.
+        The rows of the pending batch are visible to this store right away, to the
+        other processes writing into the same file once flushed. The metadata
+        files are kept in the `metadata' table under their names.
+
+        The images are kept apart from the tile coordinates (`images' and `map'
+        tables joined by the `tiles' view), duplicate tiles share one image row.
+        An image is identified by the MD5 of its content: a tile written again gets
+        a row of its own and leaves the image of the tiles linked to it as it was.
+        With an index the existing tiles are loaded by one query of the `map' table.
+        """
+
+        batch_size = 1000
+
+        def __init__(self, path, replace=False, index=None, read_only=False):
+                self.path = path
+                if not read_only:
+                        ensure_dir_exists(os.path.abspath(self.path))
+                if replace and os.path.exists(self.path):
+                        os.unlink(self.path)
+                # Wait for the other worker processes committing their batches
+                # Used by the write threads too, always under the store lock of the image output
+                self.db = sqlite3.connect(self.path, timeout=600, check_same_thread=False)
+                self.db.text_factory = str
+                self.pending = {}
+                self.pending_images = {}
+                self.index = index
+                self.read_only = read_only
+                if read_only:
+                        # No file: URIs (mode=ro) in the sqlite3 module of Python 2, any write
+                        # is refused instead, and the schema is taken as it is
+                        self.db.execute("PRAGMA query_only = ON")
+                        self.refresh()
+                        return
+                self.db.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)")
+                self.db.execute("CREATE UNIQUE INDEX IF NOT EXISTS name ON metadata (name)")
+                self.db.execute("CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT)")
+                self.db.execute("CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row)")
+                self.db.execute("CREATE TABLE IF NOT EXISTS images (tile_id TEXT, tile_data BLOB)")
+                self.db.execute("CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id)")
+                self.db.execute("CREATE VIEW IF NOT EXISTS tiles AS SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, "
+                        "map.tile_row AS tile_row, images.tile_data AS tile_data FROM map JOIN images ON images.tile_id = map.tile_id")
+                self.db.commit()
+                self.refresh()
+
+        def refresh(self):
+                # The tiles are in one image format, the index is kept without the extension
+                if self.index is not None:
+                        self.flush()
+                        self.index.clear()
+                        for tz, tx, ty in self.db.execute("SELECT zoom_level, tile_column, tile_row FROM map"):
+                                self.index.add(tx, ty, tz, None)
+
+        def get_full_path(self, tx, ty, tz, extension):
+                return "%s#%d/%d/%d" % (self.path, tz, tx, ty)
+
+        def tile_exists(self, tx, ty, tz, extension):
+                if self.index is not None:
+                        return self.index.contains(tx, ty, tz, None)
+                if (tz, tx, ty) in self.pending:
+                        return True
+                return self.db.execute("SELECT 1 FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                        (tz, tx, ty)).fetchone() is not None
+
+        def write_tile(self, tx, ty, tz, extension, dstile, image_format, options=None):
+                return self.store_encoded_tile(tx, ty, tz, extension,
+                        self.encode_tile(tx, ty, tz, extension, dstile, image_format, options))
+
+        def encode_tile(self, tx, ty, tz, extension, dstile, image_format, options=None):
+                return gdal_encode(dstile, image_format, options)
+
+        def store_encoded_tile(self, tx, ty, tz, extension, encoded):
+                tile_id = hashlib.md5(encoded).hexdigest()
+                self.pending_images[tile_id] = encoded
+                return self.link_tile(tx, ty, tz, extension, tile_id)
+
+        def encoded_size(self, encoded):
+                return len(encoded)
+
+        def link_tile(self, tx, ty, tz, extension, ref):
+                # MBTiles uses the TMS tile numbering as gdal2tiles does
+                self.pending[(tz, tx, ty)] = ref
+                if self.index is not None:
+                        self.index.add(tx, ty, tz, None)
+                if len(self.pending) >= self.batch_size:
+                        self.flush()
+                return ref
+
+        def import_tile(self, source, tx, ty, tz, extension):
+                data = source.read_tile_data(tx, ty, tz, extension)
+                tile_id = hashlib.md5(data).hexdigest()
+                self.pending_images[tile_id] = data
+                self.link_tile(tx, ty, tz, extension, tile_id)
+
+        def read_tile(self, tx, ty, tz, extension):
+                return gdal_decode(self.read_tile_data(tx, ty, tz, extension))
+
+        def read_existing_tile(self, tx, ty, tz, extension):
+                if not self.tile_exists(tx, ty, tz, extension):
+                        return None
+                return self.read_tile(tx, ty, tz, extension)
+
+        def read_tile_data(self, tx, ty, tz, extension):
+                tile_id = self.pending.get((tz, tx, ty))
+                if tile_id is None:
+                        data = self.db.execute("SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                                (tz, tx, ty)).fetchone()[0]
+                else:
+                        data = self.pending_images.get(tile_id)
+                        if data is None:
+                                data = self.db.execute("SELECT tile_data FROM images WHERE tile_id=?", (tile_id,)).fetchone()[0]
+                return str(data)
+
+        def file_exists(self, name):
+                return self.db.execute("SELECT 1 FROM metadata WHERE name=?", (name,)).fetchone() is not None
+
+        def write_file(self, name, data):
+                self.write_metadata({name: data})
+
+        def write_metadata(self, values):
+                self.db.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)", values.items())
+                self.db.commit()
+
+        def flush(self):
+                if self.pending:
+                        self.db.executemany("INSERT OR REPLACE INTO images (tile_id, tile_data) VALUES (?, ?)",
+                                [(tile_id, sqlite3.Binary(data)) for tile_id, data in self.pending_images.iteritems()])
+                        self.db.executemany("INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)",
+                                [(tz, tx, ty, tile_id) for (tz, tx, ty), tile_id in self.pending.iteritems()])
+                        self.db.commit()
+                        self.pending = {}
+                        self.pending_images = {}
+
+        def close(self, complete=True):
+                self.flush()
+                if complete and not self.read_only:
+                        # Images of the tiles written again, no tile is linked to them anymore
+                        self.db.execute("DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)")
+                        self.db.commit()
+                self.db.close()
+
+
+class TileIndex(object):
+
+        """Set of the tiles (tx, ty, tz, extension) present in a tile store.
+
+        The tiles within the ranges of the zoom levels generated are kept as one bitmap
+        per zoom level and extension, one bit per tile of the tminmax rectangle. Any
+        tile out of the ranges goes into a plain set.
+        """
+
+        def __init__(self, tminmax, levels):
+                self.ranges = dict((tz, tminmax[tz]) for tz in levels)
+                self.clear()
+
+        def clear(self):
+                self.bitmaps = {}
+                self.others = set()
+
+        def bit(self, tx, ty, tz):
+                """Return the position of the tile in the bitmap of its level, None if out of the range."""
+                r = self.ranges.get(tz)
+                if r is None or not (r[0] <= tx <= r[2] and r[1] <= ty <= r[3]):
+                        return None
+                return (ty - r[1]) * (r[2] - r[0] + 1) + (tx - r[0])
+
+        def add(self, tx, ty, tz, extension):
+                i = self.bit(tx, ty, tz)
+                if i is None:
+                        self.others.add((tx, ty, tz, extension))
+                        return
+                bitmap = self.bitmaps.get((tz, extension))
+                if bitmap is None:
+                        r = self.ranges[tz]
+                        bitmap = self.bitmaps[(tz, extension)] = bytearray(((r[2]-r[0]+1) * (r[3]-r[1]+1) + 7) / 8)
+                bitmap[i >> 3] |= 1 << (i & 7)
+
+        def contains(self, tx, ty, tz, extension):
+                i = self.bit(tx, ty, tz)
+                if i is None:
+                        return (tx, ty, tz, extension) in self.others
+                bitmap = self.bitmaps.get((tz, extension))
+                return bitmap is not None and bool(bitmap[i >> 3] & (1 << (i & 7)))
+
+
+class TileCache(object):
+
+        """Memory bounded cache of the raw pixels of the tiles produced in this run,
+        keyed by (tx, ty, tz).
+
+        Every tile is needed only once, by its parent, so it is dropped as soon as it
+        is taken. Only the tiles whose parent is built by the same process are put in
+        it, the others would never be taken. The parents take the tiles in about the
+        order they were produced, so when the memory cap is reached the tiles in the
+        cache are kept and the new ones are not cached: their parents fall back to
+        reading them from disk.
+        """
+
+        def __init__(self, max_size):
+                self.max_size = max_size
+                self.size = 0
+                self.tiles = OrderedDict()
+
+        def put(self, key, bands, data):
+                self.take(key)
+                if self.size + len(data) > self.max_size:
+                        return
+                self.tiles[key] = (bands, data)
+                self.size += len(data)
+
+        def peek(self, key):
+                return self.tiles.get(key)
+
+        def take(self, key):
+                entry = self.tiles.pop(key, None)
+                if entry is not None:
+                        self.size -= len(entry[1])
+                return entry
+
+
+class MosaicReader(object):
+
+        """Pixels of the --mosaic inputs composed on request, one query at a time. The
+        window of the query is warped from all the warped inputs at once into a MEM
+        dataset, through their alpha bands: the later sources are drawn over the
+        earlier ones and only the inputs meeting the window are read. Every worker
+        process composes its own queries.
+
+        The data and the alpha of a query are read one after the other, so the last
+        composed window is kept for the second read.
+        """
+
+        def __init__(self, sources, mosaic_ds, srs_wkt, warp_threads):
+                self.sources = sources
+                self.gt = mosaic_ds.GetGeoTransform()
+                self.bands = mosaic_ds.RasterCount
+                self.data_type = mosaic_ds.GetRasterBand(1).DataType
+                self.srs_wkt = srs_wkt
+                self.warp_options = ['NUM_THREADS=%s' % warp_threads, 'INIT_DEST=0']
+                self.mem_drv = get_gdal_driver("MEM")
+                self.window = None
+                self.ds = None
+
+        def compose(self, xyzzy):
+                window = (xyzzy.rx, xyzzy.ry, xyzzy.rxsize, xyzzy.rysize, xyzzy.wxsize, xyzzy.wysize)
+                if window != self.window:
+                        # The query window of the mosaic's grid at the size of the buffer
+                        gt = self.gt
+                        ds = self.mem_drv.Create('', xyzzy.wxsize, xyzzy.wysize, self.bands, self.data_type)
+                        ds.SetGeoTransform((gt[0] + xyzzy.rx * gt[1], gt[1] * xyzzy.rxsize / float(xyzzy.wxsize), 0.0,
+                                            gt[3] + xyzzy.ry * gt[5], 0.0, gt[5] * xyzzy.rysize / float(xyzzy.wysize)))
+                        ds.SetProjection(self.srs_wkt)
+                        if not gdal.Warp(ds, self.sources, resampleAlg='near', srcAlpha=True, dstAlpha=True,
+                                         multithread=True, warpOptions=self.warp_options):
+                                raise ImageOutputException("It is not possible to compose the mosaic of the input files.")
+                        self.window, self.ds = window, ds
+                return self.ds
+
+        def read(self, xyzzy, band_list):
+                return self.compose(xyzzy).ReadRaster(0, 0, xyzzy.wxsize, xyzzy.wysize, band_list=band_list)
+
+        def read_alpha(self, xyzzy):
+                return self.compose(xyzzy).GetRasterBand(self.bands).ReadRaster(0, 0, xyzzy.wxsize, xyzzy.wysize)
+
+
+def gdal_write(path, dstile, image_format, options=None):
         ensure_dir_exists(path)
         driver = get_gdal_driver(image_format)
-        driver.CreateCopy(path, dstile, strict=0)
+        driver.CreateCopy(path, dstile, strict=0, options=options or [])
+
+
+def gdal_encode(dstile, image_format, options=None):
+        """Return the content of the image file of the tile, encoded in memory."""
+        path = "/vsimem/gdal2tiles_%d_%x.%s" % (os.getpid(), id(dstile), format_extension[image_format])
+        driver = get_gdal_driver(image_format)
+        driver.CreateCopy(path, dstile, strict=0, options=options or [])
+        f = gdal.VSIFOpenL(path, 'rb')
+        gdal.VSIFSeekL(f, 0, 2)
+        size = gdal.VSIFTellL(f)
+        gdal.VSIFSeekL(f, 0, 0)
+        data = gdal.VSIFReadL(1, size, f)
+        gdal.VSIFCloseL(f)
+        gdal.Unlink(path)
+        return data
+
+
+def gdal_decode(data):
+        """Return the number of bands and the pixels of the tile from its image file content."""
+        path = "/vsimem/gdal2tiles_%d_%x" % (os.getpid(), id(data))
+        gdal.FileFromMemBuffer(path, data)
+        dstile = gdal.Open(path, gdal.GA_ReadOnly)
+        result = dstile.RasterCount, dstile.ReadRaster(0, 0, dstile.RasterXSize, dstile.RasterYSize)
+        dstile = None
+        gdal.Unlink(path)
+        return result
+
+
+def coordinate_transformation(src_srs, dst_srs):
+        """CoordinateTransformation taking and giving x, y (lon, lat) also with GDAL 3,
+        which follows the axis order of the coordinate system authority otherwise."""
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+                src_srs, dst_srs = src_srs.Clone(), dst_srs.Clone()
+                src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+                dst_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        return osr.CoordinateTransformation(src_srs, dst_srs)
+
+
+def replace_file(src, dst):
+        try:
+                os.rename(src, dst)
+        except OSError:
+                # Windows does not rename over an existing file
+                os.unlink(dst)
+                os.rename(src, dst)
 
 
 def get_gdal_driver(name):
@@ -1640,19 +3942,126 @@ def get_gdal_driver(name):
 
 
 def get_tile_filename(tx, ty, tz, extension):
-		gx, gy = GlobalMercator().GoogleTile(tx, ty, tz)
-		return os.path.join(str(tz), str(gx), "%s.%s" % (gy, extension))
+		# Google tile numbering as GlobalMercator.GoogleTile, without the instance per call
+		gy = (1 << tz) - 1 - ty
+		return os.path.join(str(tz), str(tx), "%s.%s" % (gy, extension))
 
 
 def ensure_dir_exists(path):
         dirname = os.path.dirname(path)
-        if not os.path.exists(dirname):
-                os.makedirs(dirname)
+        if dirname and not os.path.exists(dirname):
+                try:
+                        os.makedirs(dirname)
+                except OSError:
+                        # Created meanwhile by another worker process
+                        if not os.path.isdir(dirname):
+                                raise
+
+
+class Stats(object):
+
+        """Statistics of the tile generation for --stats: the calls, seconds and bytes
+        of its phases and the histogram of the encoded tile sizes by zoom level.
+
+        The hot paths time a phase by `start' and `stop', which do nothing unless the
+        statistics are enabled. The worker processes hand theirs over to the main
+        process by `take' and `merge'. The writer threads share them under the lock.
+        """
+
+        def __init__(self):
+                self.enabled = False
+                self.lock = threading.Lock()
+                self.clear()
+
+        def clear(self):
+                self.phases = {}
+                self.tile_sizes = {}
+
+        def start(self):
+                if self.enabled:
+                        return time.time()
+                return None
+
+        def stop(self, phase, start, nbytes=0):
+                """Account the phase started at start, return the start of the next one."""
+                if start is None:
+                        return None
+                now = time.time()
+                with self.lock:
+                        p = self.phases.get(phase)
+                        if p is None:
+                                p = self.phases[phase] = [0, 0.0, 0]
+                        p[0] += 1
+                        p[1] += now - start
+                        p[2] += nbytes
+                return now
+
+        def add_tile(self, tz, size):
+                """Account an encoded tile of size bytes, in the power of 2 bucket above it."""
+                if not self.enabled:
+                        return
+                bucket = 1
+                while bucket < size:
+                        bucket <<= 1
+                with self.lock:
+                        sizes = self.tile_sizes.setdefault(tz, {})
+                        sizes[bucket] = sizes.get(bucket, 0) + 1
+
+        def calls(self, phase):
+                p = self.phases.get(phase)
+                return p and p[0] or 0
+
+        def take(self):
+                if not self.enabled:
+                        return None
+                with self.lock:
+                        taken = (self.phases, self.tile_sizes)
+                        self.clear()
+                return taken
+
+        def merge(self, taken):
+                if taken is None:
+                        return
+                phases, tile_sizes = taken
+                with self.lock:
+                        for phase, (calls, seconds, nbytes) in phases.items():
+                                p = self.phases.setdefault(phase, [0, 0.0, 0])
+                                p[0] += calls
+                                p[1] += seconds
+                                p[2] += nbytes
+                        for tz, buckets in tile_sizes.items():
+                                sizes = self.tile_sizes.setdefault(tz, {})
+                                for bucket, count in buckets.items():
+                                        sizes[bucket] = sizes.get(bucket, 0) + count
+
+        def as_dict(self):
+                return {'phases': dict((phase, {'calls': c, 'seconds': s, 'bytes': b})
+                                       for phase, (c, s, b) in self.phases.items()),
+                        'tile_sizes': dict((str(tz), dict((str(bucket), count) for bucket, count in buckets.items()))
+                                           for tz, buckets in self.tile_sizes.items())}
+
+# The statistics of this process
+STATS = Stats()
+
+
+def store_tile(store, store_lock, tx, ty, tz, extension, dstile, image_format, options=None):
+        """Encode the tile and put it into the store, under the store lock. Returns the
+        reference of the tile in the store."""
+        t = STATS.start()
+        encoded = store.encode_tile(tx, ty, tz, extension, dstile, image_format, options)
+        if t is not None:
+                size = store.encoded_size(encoded)
+                t = STATS.stop('encode', t, size)
+                STATS.add_tile(tz, size)
+        with store_lock:
+                ref = store.store_encoded_tile(tx, ty, tz, extension, encoded)
+        STATS.stop('store', t)
+        return ref
 
 
 class Xyzzy(object):
 
-        """Collection of coordinates describing what to read where for the given tile at the base level."""
+        """Collection of coordinates describing what to read where for the given tile (or metatile block) at the base level."""
 
         def __init__(self, querysize, rx, ry, rxsize, rysize, wx, wy, wxsize, wysize):
                 self.querysize = querysize
@@ -1665,6 +4074,101 @@ class Xyzzy(object):
                 self.wxsize = wxsize
                 self.wysize = wysize
 
+        def covers_query(self):
+                """Does the read fill the whole query, with no border left over?"""
+                return self.wx == 0 and self.wy == 0 and self.wxsize == self.querysize and self.wysize == self.querysize
+
+
+# =============================================================================
+
+# Worker process side of --processes. Every worker sets up its own GDAL2Tiles
+# (and so its own copy of out_ds, GDAL datasets can't be shared between processes)
+# and then renders the batches of tiles it pulls from the pool's task queue.
+
+_worker_job = None
+_worker_tiler = None
+
+def worker_tiler(job):
+        """Return the tiler of this worker process for the job, set up on its first batch.
+        The tiler of the previous job is let go."""
+        global _worker_job, _worker_tiler
+        if job != _worker_job:
+                if _worker_tiler is not None:
+                        _worker_tiler.image_output.close()
+                        _worker_tiler.store.close(False)
+                        if _worker_tiler.previous_store:
+                                _worker_tiler.previous_store.close()
+                        _worker_tiler.close_input()
+                _worker_job = _worker_tiler = None
+
+                state_file, arguments = job
+                f = open(state_file, 'rb')
+                state = cPickle.load(f)
+                f.close()
+                try:
+                        tiler = GDAL2Tiles(arguments)
+                        tiler.is_worker = True
+                        for name, value in state.items():
+                                setattr(tiler, name, value)
+                        tiler.open_input()
+                except SystemExit:
+                        # A worker process must not exit, the pool would wait for it forever
+                        raise ImageOutputException("The worker process failed to set up the input.")
+                _worker_job, _worker_tiler = job, tiler
+        return _worker_tiler
+
+
+def base_tiles_worker(task):
+        job, batch = task
+        tiler = worker_tiler(job)
+        # The overview tiles are built from the store, by other processes
+        tiler.image_output.cache_minz = tiler.tmaxz
+        count = 0
+        for bx, by, size, tz in batch:
+                count += tiler.generate_base_block(bx, by, size, tz)
+        tiler.image_output.flush()
+        return count, STATS.take()
+
+
+def overview_subtree_worker(task):
+        job, (tx, ty, tz) = task
+        tiler = worker_tiler(job)
+        tiler.image_output.cache_minz = tz
+        count = tiler.generate_overview_subtree(tx, ty, tz)
+        # The parent levels are made by the main process from these tiles
+        tiler.image_output.flush()
+        return count, STATS.take()
+
+
+def depth_first_worker(task):
+        job, (tx, ty, tz) = task
+        tiler = worker_tiler(job)
+        tiler.image_output.cache_minz = tz
+        count = sum(tiler.iter_depth_first(tx, ty, tz))
+        tiler.image_output.flush()
+        return count, STATS.take()
+
+
+def strip_quotes(arg):
+        """Return the argument split by shlex in non-POSIX mode without its quotes"""
+        if len(arg) > 1 and arg[0] == arg[-1] and arg[0] in '"\'':
+                return arg[1:-1]
+        return arg
+
+
+def chart_worker(arguments):
+        """Processing of one whole chart of a --batch in a worker process (arguments with
+        --processes 1). Returns its output and statistics (None without --stats)."""
+        tiler = GDAL2Tiles(arguments)
+        tiler.in_batch = True
+        # The progress bars of the charts processed side by side would garble each other
+        tiler.progressbar = lambda complete = 0.0: None
+        try:
+                tiler.process()
+        except SystemExit:
+                raise ImageOutputException("Processing of '%s' failed." % tiler.input)
+        return tiler.output, tiler.stats
+
 
 # =============================================================================
 
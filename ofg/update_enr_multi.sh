@@ -31,7 +31,7 @@ export FAA_BASE_URL_SED="http:\/\/aeronav.faa.gov\/"
 export SKIP="ENR_H ENR_P"
 # Open flight map code depends upon this file being named
 export MAP_METADATA_FILE="mapmetadata.html"
-export PATH="${PROCESSING_ROOT}/bin:${PROCESSING_ROOT}/bin/ImageMagick-6.8.6-10:$PATH"
+export PATH="${PROCESSING_ROOT}/bin:$PATH"
 
 if [ ! -d WORK_enroute ]
 then
@@ -38,47 +38,26 @@ do
 	# process with non-space-containing filename, and restore the file to it's original name
 	mv "$tifname" ${PRODUCT}.tif			
 	
-	# file, no translate
-	GDAL.bat ${PRODUCT}.tif $ZOOMS geonotranslate
-	
-	cd ${PRODUCT}
-	
-	# reduce the size by about 1/2 
-	find . -type f -name \*.jpg -print | while read cvtline
-	do
-		convert -quality 25 $cvtline $cvtline
-	done			
-	
-	# clean out some garbage left by 2tiles
-	rm -f googlemaps.html openlayers.html
-	
-	find . -name \*.jpg | while read jpgline
-	do 
-		mv ${jpgline} `echo $jpgline | sed 's/.jpg/.ofm/'`
-	done
-
-
-	
 	# manually build the xml file since it doesn't have the required attributes
 	# for geo, and the expiry dates are in the urls
-	DATA=`grep West_Bounding_Coordinate ../${METADATA_TMP_FILE} | sed -e 's/.*em>//' -e 's/ //g' -e 's/<\/dt>//'`
+	DATA=`grep West_Bounding_Coordinate ${METADATA_TMP_FILE} | sed -e 's/.*em>//' -e 's/ //g' -e 's/<\/dt>//'`
 	echo "dc.coverage.x.min=${DATA}" > $MAP_METADATA_FILE
-	DATA=`grep East_Bounding_Coordinate ../${METADATA_TMP_FILE} | sed -e 's/.*em>//' -e 's/ //g' -e 's/<\/dt>//'`
+	DATA=`grep East_Bounding_Coordinate ${METADATA_TMP_FILE} | sed -e 's/.*em>//' -e 's/ //g' -e 's/<\/dt>//'`
 	echo "dc.coverage.x.max=${DATA}" >> $MAP_METADATA_FILE
-	DATA=`grep North_Bounding_Coordinate ../${METADATA_TMP_FILE} | sed -e 's/.*em>//' -e 's/ //g' -e 's/<\/dt>//'`
+	DATA=`grep North_Bounding_Coordinate ${METADATA_TMP_FILE} | sed -e 's/.*em>//' -e 's/ //g' -e 's/<\/dt>//'`
 	echo "dc.coverage.y.max=${DATA}" >> $MAP_METADATA_FILE
-	DATA=`grep South_Bounding_Coordinate ../${METADATA_TMP_FILE} | sed -e 's/.*em>//' -e 's/ //g' -e 's/<\/dt>//'`
+	DATA=`grep South_Bounding_Coordinate ${METADATA_TMP_FILE} | sed -e 's/.*em>//' -e 's/ //g' -e 's/<\/dt>//'`
 	echo "dc.coverage.y.min=${DATA}" >> $MAP_METADATA_FILE		
 	echo "dc.coverage.t.min=${DATE_EFF}" >> $MAP_METADATA_FILE	
 	echo "dc.coverage.t.max=${DATE_EXP}" >> $MAP_METADATA_FILE		
 	
-	# create product .zip file
-	7z a ../../../${PRODUCT}.zip *
+	# file, no translate; tiles are written at quality 25 (about 1/2 the size) as .ofm,
+	# straight into the product .zip file along with the metadata descriptor
+	GDAL.bat ${PRODUCT}.tif $ZOOMS geonotranslate 25 ../../${PRODUCT}.zip $MAP_METADATA_FILE
 	
 	# cleanup
-	cd ..				
 	mv ${PRODUCT}.tif "$tifname"
-	rm -rf ${PRODUCT}
+	rm -f $MAP_METADATA_FILE
 	
 done
 
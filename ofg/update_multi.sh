@@ -27,7 +27,7 @@ export ZOOMS="5-9"
 export FAA_BASE_URL_SED="http:\/\/aeronav.faa.gov\/"
 # Open flight map code depends upon this file being named
 export MAP_METADATA_FILE="mapmetadata.html"
-export PATH="${PROCESSING_ROOT}/bin:${PROCESSING_ROOT}/bin/ImageMagick-6.8.6-10:$PATH"
+export PATH="${PROCESSING_ROOT}/bin:$PATH"
 
 cd WORK_${VFR_PRODUCT}
 
@@ -39,34 +39,17 @@ METADATA_TMP_FILE="`echo $tifname | sed 's/.tif/.htm/'`"
 # process with non-space-containing filename
 mv *.tif ${PRODUCT}.tif			
 
-GDAL.bat ${PRODUCT}.tif $ZOOMS $GEOREF
-cd temp
-
-# reduce the size by about 1/2 
-find . -type f -name \*.jpg -print | while read cvtline
-do
-	convert -quality 45 $cvtline $cvtline
-done	
-
-# clean out some garbage left by 2tiles
-rm -f googlemaps.html openlayers.html
-
-# rename to our suffix
-find . -name \*.jpg | while read jpgline
-do 
-	mv ${jpgline} `echo $jpgline | sed 's/.jpg/.ofm/'`
-done	
-
 # copy in the metadata descriptor (and give it a universal name)
-cp "../${METADATA_TMP_FILE}" $MAP_METADATA_FILE
+cp "${METADATA_TMP_FILE}" $MAP_METADATA_FILE
 
-# create product .zip file
-7z a ../../../${PRODUCT}.zip *
+# tiles are written at quality 45 (reduces the size by about 1/2) as .ofm,
+# straight into the product .zip file along with the metadata descriptor
+GDAL.bat ${PRODUCT}.tif $ZOOMS $GEOREF 45 ../../${PRODUCT}.zip $MAP_METADATA_FILE
 
 # cleanup
-cd ..				
 mv ${PRODUCT}.tif "$tifname"
 rm -rf temp*
+rm -f $MAP_METADATA_FILE
 rm -rf ${PRODUCT}	
 
 